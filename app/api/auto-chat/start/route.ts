@@ -3,6 +3,7 @@ import { verifyAuth, handleAuthError } from '@/lib/auth'
 import { PrismaClient } from '@prisma/client'
 import { spawn } from 'child_process'
 import path from 'path'
+import { callWorker } from '@/lib/worker'
 
 const prisma = new PrismaClient()
 
@@ -23,6 +24,12 @@ export async function POST(request: NextRequest): Promise<NextResponse> {
     // 获取请求参数
     console.log("Request parameters:", data);
 
+    // 自动聊天在单独的进程里打开session文件，先让worker断开这些session的连接（正在运行的任务最多等5秒）
+    const released = await callWorker<{ released: string[]; busy: string[] }>('release', { user_email: email, wait: 5 }, 10000)
+    if (released?.success && released.result.busy.length > 0) {
+      console.warn(`[Worker] sessions still in use by a worker job: ${released.result.busy.join(', ')}`)
+    }
+
     return new Promise((resolve) => {
       const rootDir = process.cwd();
       const scriptPath = path.join(rootDir, 'scripts', 'auto_chat.py');
@@ -44,10 +51,15 @@ export async function POST(request: NextRequest): Promise<NextResponse> {
         return;
       }
       
+      // 每次运行一个ID，状态文件按它命名；Windows上python可能经过启动器或venv转发，子进程PID和spawn拿到的不一定相同
+      const runId = `${Date.now()}_${Math.random().toString(36).slice(2, 8)}`;
+      const statusFile = path.join(rootDir, 'scraped_data', email, 'auto_chat_status', `${runId}.json`);
+
       // 构建命令行参数
       const args = [
         scriptPath,
         '--user-email', email,
+        '--status-file', statusFile,
         '--root-dir', 'D:/tg-bot-web',  // 使用正斜杠
         '--target-group', data.targetGroup,
         '--message-source', data.messageSource,
@@ -90,6 +102,8 @@ export async function POST(request: NextRequest): Promise<NextResponse> {
         resolve(NextResponse.json({
           success: true,
           message: 'Auto chat process started successfully',
+          // 状态接口按这个运行ID读取对应的状态文件
+          runId,
           data: text.trim()
         }));
       });
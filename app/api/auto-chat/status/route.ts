@@ -1,5 +1,35 @@
 import { NextRequest, NextResponse } from 'next/server'
 import { verifyAuth, handleAuthError } from '@/lib/auth'
+import path from 'path'
+import fs from 'fs'
+
+// auto_chat.py每30秒写一次状态文件，超过这个时间没有更新就认为进程已经停止
+const STATUS_STALE_MS = 120000
+// 运行ID以启动时间开头，启动后这段时间内还没有状态文件视为正在启动
+const STATUS_START_GRACE_MS = 30000
+
+function isProcessAlive(pid: number): boolean {
+  try {
+    process.kill(pid, 0)
+    return true
+  } catch (e: any) {
+    // EPERM说明进程存在但没有权限发信号
+    return e.code === 'EPERM'
+  }
+}
+
+function latestStatusFile(statusDir: string): string | null {
+  if (!fs.existsSync(statusDir)) {
+    return null
+  }
+  const files = fs.readdirSync(statusDir)
+    .filter(name => name.endsWith('.json'))
+    .map(name => path.join(statusDir, name))
+  if (!files.length) {
+    return null
+  }
+  return files.reduce((latest, file) => fs.statSync(file).mtimeMs > fs.statSync(latest).mtimeMs ? file : latest)
+}
 
 export async function POST(request: NextRequest) {
   try {
@@ -9,23 +39,50 @@ export async function POST(request: NextRequest) {
       return handleAuthError(auth.error!)
     }
 
-    const { processId } = await request.json()
-
-    if (!processId) {
+    const { email } = auth.user!
+    const { runId } = await request.json().catch(() => ({}))
+    if (runId && !/^[\w-]+$/.test(String(runId))) {
       return NextResponse.json({
         success: false,
-        message: 'Process ID is required'
+        message: 'Invalid run id'
       }, { status: 400 })
     }
 
-    // 这里可以添加进程状态检查的逻辑
-    // 例如检查进程是否仍在运行，获取输出等
-    
+    // 读取auto_chat.py写入的状态摘要：每次运行一个文件，没有指定运行ID时用最近更新的一个
+    // 正常结束的运行会删除自己的状态文件
+    const statusDir = path.join(process.cwd(), 'scraped_data', email, 'auto_chat_status')
+    const statusFile = runId
+      ? path.join(statusDir, `${runId}.json`)
+      : latestStatusFile(statusDir)
+    if (!statusFile || !fs.existsSync(statusFile)) {
+      if (runId && Date.now() - parseInt(String(runId), 10) < STATUS_START_GRACE_MS) {
+        // 进程刚启动，还没写第一次状态
+        return NextResponse.json({
+          success: true,
+          running: true,
+          output: 'Auto chat is starting',
+          error: null
+        })
+      }
+      return NextResponse.json({
+        success: true,
+        running: false,
+        output: 'No auto chat status found',
+        error: null
+      })
+    }
+
+    const status = JSON.parse(fs.readFileSync(statusFile, 'utf-8'))
+    const pid = status.pid
+    const fresh = Date.now() - new Date(status.updatedAt).getTime() < STATUS_STALE_MS
+    const running = Boolean(status.running) && fresh && isProcessAlive(pid)
+
     return NextResponse.json({
       success: true,
-      running: true, // 根据实际情况返回
-      output: `Process ${processId} is running...`,
-      error: null
+      running,
+      output: `Sent ${status.sent}, failed ${status.failed}, cycle ${status.cycle}, p50 ${status.latencyMs?.p50 ?? '-'}ms, flood waits ${status.floodWaits?.count ?? 0}`,
+      error: null,
+      metrics: status
     })
 
   } catch (error) {
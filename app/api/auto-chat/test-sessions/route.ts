@@ -4,6 +4,7 @@ import { PrismaClient } from '@prisma/client'
 import { spawn } from 'child_process'
 import path from 'path'
 import fs from 'fs'
+import { callWorker } from '@/lib/worker'
 
 const prisma = new PrismaClient()
 
@@ -17,9 +18,9 @@ export async function POST(request: NextRequest): Promise<Response> {
 
     const { email } = auth.user!
 
-    // Get root directory and sessions directory
+    // Get root directory and the user's sessions directory
     const rootDir = path.resolve(process.cwd())
-    const sessionsDir = path.join(rootDir, 'sessions')
+    const sessionsDir = path.join(rootDir, 'sessions', email)
     const scriptPath = path.join(rootDir, 'scripts', 'test_sessions.py')
 
     // Verify sessions directory exists
@@ -41,8 +42,20 @@ export async function POST(request: NextRequest): Promise<Response> {
       )
     }
 
+    // 优先使用常驻worker，和chat-scraper的测试接口一样
+    const workerResponse = await callWorker<any[]>('test_sessions', { sessions_dir: sessionsDir })
+    if (workerResponse) {
+      if (workerResponse.success) {
+        return NextResponse.json(workerResponse.result)
+      }
+      return NextResponse.json(
+        { success: false, message: workerResponse.error || 'Failed to test sessions' },
+        { status: 500 }
+      )
+    }
+
     return new Promise<Response>((resolve) => {
-      const pythonProcess = spawn('python', [scriptPath, email], {
+      const pythonProcess = spawn('python', [scriptPath, '--sessions-dir', sessionsDir], {
         env: {
           ...process.env,
           PYTHONIOENCODING: 'utf-8'
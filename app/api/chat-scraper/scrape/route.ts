@@ -2,6 +2,7 @@ import { NextRequest, NextResponse } from 'next/server'
 import { verifyAuth, handleAuthError } from '@/lib/auth'
 import { spawn } from 'child_process'
 import path from 'path'
+import { callWorker } from '@/lib/worker'
 
 export async function POST(request: NextRequest): Promise<NextResponse> {
   try {
@@ -12,26 +13,94 @@ export async function POST(request: NextRequest): Promise<NextResponse> {
     }
 
     const { email } = auth.user!
-    const { sessionFile, groupUsername, messageLimit } = await request.json()
+    const {
+      sessionFile, groupUsername, groups, messageLimit, incremental, outputFormat, exportMode,
+      types, since, until, topicId
+    } = await request.json()
+    // 传入groups时在一个进程里用同一个连接并发抓取多个群组
+    const groupList: string[] = Array.isArray(groups) && groups.length > 0 ? groups : [groupUsername].filter(Boolean)
 
-    if (!sessionFile || !groupUsername) {
+    if (!sessionFile || groupList.length === 0) {
       return NextResponse.json(
         { success: false, message: 'Missing required parameters' },
         { status: 400 }
       )
     }
 
+    // 优先使用常驻worker，复用已连接的客户端
+    const workerResponse = await callWorker<{ csv_file?: string; results?: any[] }>('scrape', {
+      session: sessionFile,
+      ...(groupList.length > 1 ? { groups: groupList } : { group: groupList[0] }),
+      limit: messageLimit || 1000,
+      user_email: email,
+      incremental: !!incremental,
+      output_format: outputFormat === 'parquet' ? 'parquet' : 'csv',
+      export: !!exportMode,
+      // 只抓取指定类型、时间范围或话题的消息
+      ...(Array.isArray(types) && types.length > 0 ? { types } : {}),
+      ...(since ? { since } : {}),
+      ...(until ? { until } : {}),
+      ...(topicId ? { topic_id: Number(topicId) } : {})
+    }, 30 * 60 * 1000)
+    if (workerResponse) {
+      if (workerResponse.success) {
+        return NextResponse.json({
+          success: true,
+          message: 'Messages scraped successfully',
+          output: JSON.stringify(groupList.length > 1
+            ? { type: 'batch_complete', results: workerResponse.result.results }
+            : { type: 'complete', csv_file: workerResponse.result.csv_file })
+        })
+      }
+      return NextResponse.json({
+        success: false,
+        message: 'Failed to scrape messages',
+        error: workerResponse.error
+      }, { status: workerResponse.status === 400 || workerResponse.status === 409 ? workerResponse.status : 500 })
+    }
+
     // 构建Python脚本路径
     const scriptPath = path.join(process.cwd(), 'scripts', 'scrape_messages.py')
 
+    const args = [
+      scriptPath,
+      '--session', sessionFile,
+      '--group', ...groupList,
+      '--limit', messageLimit?.toString() || '1000',
+      '--user-email', email
+    ]
+
+    // 增量模式：只抓取上次之后的新消息并追加
+    if (incremental) {
+      args.push('--incremental')
+    }
+
+    // 额外输出Parquet格式的消息源
+    if (outputFormat === 'parquet') {
+      args.push('--output-format', 'parquet')
+    }
+
+    // 导出模式：在takeout会话里抓取完整历史，被拒绝时自动回退到普通抓取
+    if (exportMode) {
+      args.push('--export')
+    }
+
+    // 服务端过滤：消息类型、时间范围和论坛话题
+    if (Array.isArray(types) && types.length > 0) {
+      args.push('--types', ...types)
+    }
+    if (since) {
+      args.push('--since', since)
+    }
+    if (until) {
+      args.push('--until', until)
+    }
+    if (topicId) {
+      args.push('--topic-id', String(topicId))
+    }
+
     return new Promise((resolve) => {
-      const process = spawn('python', [
-        scriptPath,
-        '--session', sessionFile,
-        '--group', groupUsername,
-        '--limit', messageLimit?.toString() || '1000',
-        '--user-email', email
-      ])
+      const process = spawn('python', args)
 
       let output = ''
       let error = ''
@@ -3,6 +3,7 @@ import { verifyAuth, handleAuthError } from '@/lib/auth'
 import { spawn } from 'child_process'
 import path from 'path'
 import fs from 'fs'
+import { callWorker } from '@/lib/worker'
 
 const JWT_SECRET = new TextEncoder().encode('your-jwt-secret-key')
 
@@ -50,6 +51,18 @@ export async function POST(request: NextRequest): Promise<NextResponse> {
       })
     }
 
+    // 优先使用常驻worker，已连接的session不需要重新握手
+    const workerResponse = await callWorker<any[]>('test_sessions', { sessions_dir: userSessionsDir })
+    if (workerResponse) {
+      if (workerResponse.success) {
+        return NextResponse.json({ success: true, results: workerResponse.result })
+      }
+      return NextResponse.json(
+        { success: false, message: workerResponse.error || 'Failed to test sessions' },
+        { status: 500 }
+      )
+    }
+
     const scriptPath = path.join('D:', 'tg-bot-web', 'scripts', 'test_sessions.py')
 
     return new Promise((resolve) => {
@@ -2,6 +2,7 @@ import { NextRequest, NextResponse } from 'next/server'
 import { spawn } from 'child_process'
 import path from 'path'
 import { getJwtPayload } from '@/lib/auth'
+import { callWorker } from '@/lib/worker'
 
 export async function GET(req: NextRequest) {
   try {
@@ -12,6 +13,18 @@ export async function GET(req: NextRequest) {
     }
 
     const userEmail = payload.email
+
+    // 优先使用常驻worker，已连接的session不需要重新握手
+    const workerResponse = await callWorker<any[]>('session_info', { user_email: userEmail })
+    if (workerResponse) {
+      if (workerResponse.success) {
+        return NextResponse.json({ success: true, sessions: workerResponse.result })
+      }
+      return NextResponse.json({
+        success: false,
+        error: workerResponse.error || 'Failed to get session information'
+      })
+    }
     
     // 运行 Python 脚本
     const scriptPath = path.join(process.cwd(), 'scripts', 'get_session_info.py')
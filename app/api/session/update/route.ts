@@ -5,6 +5,7 @@ import { spawn } from 'child_process'
 import fs from 'fs/promises'
 import { writeFile } from 'fs/promises'
 import { v4 as uuidv4 } from 'uuid'
+import { callWorker } from '@/lib/worker'
 
 // 设置更长的超时时间
 export const maxDuration = 300 // 5分钟
@@ -77,6 +78,24 @@ export async function POST(req: NextRequest) {
       photo_path: photoPath || undefined
     }
 
+    // 优先使用常驻worker，已连接的session不需要重新握手
+    const workerResponse = await callWorker<any>('update_profile', { user_email: payload.email, ...config })
+    if (workerResponse) {
+      const result = workerResponse.success
+        ? workerResponse.result
+        : { success: false, error: workerResponse.error || 'Failed to update profile' }
+      if (!result.success && photoPath) {
+        try {
+          await fs.unlink(photoPath)
+          console.log(`[Update Profile] 更新失败，删除上传的文件: ${photoPath}`)
+        } catch (e) {
+          console.error(`[Update Profile] 删除文件失败:`, e)
+        }
+      }
+      console.log(`[Update Profile] worker返回结果: ${payload.email}`, result)
+      return NextResponse.json(result, { status: workerResponse.success ? 200 : 500 })
+    }
+
     // 运行Python脚本
     return new Promise<Response>((resolve, reject) => {
       console.log(`[Update Profile] 开始更新用户 ${payload.email} 的账号信息，session: ${sessionName}`)
@@ -207,7 +207,7 @@ export default function AutoChat() {
       }
 
       // 如果需要持续监控进程状态，可以设置一个轮询
-      if (data.processId) {
+      if (data.runId) {
         const pollStatus = async () => {
           try {
             const statusResponse = await fetch('/api/auto-chat/status', {
@@ -215,7 +215,7 @@ export default function AutoChat() {
               headers: {
                 'Content-Type': 'application/json'
               },
-              body: JSON.stringify({ processId: data.processId })
+              body: JSON.stringify({ runId: data.runId })
             })
 
             const statusData = await statusResponse.json()
@@ -9,6 +9,15 @@ module.exports = {
       max_restarts: 10,
       restart_delay: 4000
     },
+    {
+      name: 'python-worker',
+      script: 'scripts/worker.py',
+      interpreter: 'python',
+      watch: false,
+      autorestart: true,
+      max_restarts: 10,
+      restart_delay: 4000
+    },
     {
       name: 'ngrok',
       script: 'ngrok',
@@ -0,0 +1,39 @@
+// 常驻Python worker（scripts/worker.py）的客户端
+// worker不可用时返回null，调用方回退到每次启动一个python进程
+const WORKER_URL = process.env.PYTHON_WORKER_URL || 'http://127.0.0.1:8765'
+
+export type WorkerResponse<T> =
+  | { success: true; result: T }
+  | { success: false; error: string; status?: number }
+
+export async function callWorker<T>(
+  job: string,
+  params: Record<string, unknown>,
+  timeoutMs = 240000
+): Promise<WorkerResponse<T> | null> {
+  let response: Response
+  try {
+    response = await fetch(`${WORKER_URL}/jobs/${job}`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(params),
+      signal: AbortSignal.timeout(timeoutMs),
+      cache: 'no-store'
+    })
+  } catch (error: any) {
+    // 只有连不上worker时才回退；超时说明任务可能还在运行，不能再启动一次
+    if (error?.name === 'TimeoutError') {
+      return { success: false, error: `Worker job ${job} timed out after ${timeoutMs / 1000} seconds` }
+    }
+    console.warn(`[Worker] ${job}: worker unavailable, falling back to python process`)
+    return null
+  }
+
+  try {
+    const payload = await response.json()
+    // 失败时带上HTTP状态，400是请求参数错误，409是session正被自动聊天占用，500是任务本身失败
+    return payload.success ? payload : { ...payload, status: response.status }
+  } catch (e) {
+    return { success: false, error: `Invalid response from worker (HTTP ${response.status})` }
+  }
+}
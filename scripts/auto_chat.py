@@ -1,17 +1,15 @@
 import sys
-import subprocess
-import io
-import itertools
+import startup_profile
+startup_profile.enable_if_requested()
+
 import json
 import os
-import pandas as pd
-from telethon import TelegramClient, types
 import asyncio
 import random
-from telethon.tl.types import InputPeerChannel, ReactionEmoji, DocumentAttributeVideo, DocumentAttributeAnimated
-from telethon.tl.functions.messages import GetHistoryRequest, SendReactionRequest
-import emoji
-from telethon.tl.functions.channels import JoinChannelRequest
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
 import argparse
 from config import (
     API_ID,
@@ -21,6 +19,12 @@ from config import (
     REACTION_EMOJIS,
     PROXY_CONFIGS
 )
+from message_source import get_source_paths, load_message_source, load_sticker_index, update_sticker_index, document_reference
+from chat_metrics import ChatMetrics
+from session_claims import SessionClaim
+from rate_control import rate_controller
+
+# Telethon只在连接和发送时导入，解析参数和加载消息源时不需要
 
 # 立即输出启动信息
 print("=== Auto Chat Script Starting ===")
@@ -29,40 +33,12 @@ print(f"Current working directory: {os.getcwd()}")
 print(f"Script directory: {os.path.dirname(os.path.abspath(__file__))}")
 sys.stdout.flush()  # 确保立即输出
 
-# Set UTF-8 as default encoding for stdout
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-
-def check_dependencies():
-    """检查所需的包是否已安装"""
-    required_packages = {
-        'telethon': 'Telethon',
-        'pandas': 'pandas',
-        'emoji': 'emoji',
-        'python_socks': 'python-socks[asyncio]'
-    }
-    
-    missing_packages = []
-    
-    for import_name, package_name in required_packages.items():
-        try:
-            __import__(import_name)
-            print(f"Package {package_name} is installed")
-        except ImportError as e:
-            print(f"Failed to import {package_name}: {str(e)}")
-            missing_packages.append(package_name)
-    
-    if missing_packages:
-        print("\nMissing required packages:", ", ".join(missing_packages))
-        print("Please install them using: pip install -r requirements.txt")
-        sys.exit(1)
-    else:
-        print("\nAll required packages are installed")
-
-# Check dependencies
-check_dependencies()
+# 同时连接的session数量和每次连接尝试的超时时间（秒）
+DEFAULT_CONNECT_CONCURRENCY = 10
+DEFAULT_CONNECT_TIMEOUT = 30
 
 def parse_args():
-    parser = argparse.ArgumentParser(description='Auto chat script')
+    parser = argparse.ArgumentParser(description='Auto chat script', allow_abbrev=False)
     parser.add_argument('--target-group', required=True, help='Target group URL or username')
     parser.add_argument('--topic', action='store_true', help='Whether the group has topics')
     parser.add_argument('--topic-id', type=int, help='Topic ID for topic groups')
@@ -72,10 +48,70 @@ def parse_args():
     parser.add_argument('--root-dir', required=True, help='Root directory of the project')
     parser.add_argument('--user-email', required=True, help='User email for session directory')
     parser.add_argument('--enable-loop', action='store_true', help='Enable continuous message loop')
+    parser.add_argument('--connect-concurrency', type=int, default=DEFAULT_CONNECT_CONCURRENCY, help='Number of sessions to connect at once')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, help='Timeout in seconds for each connection attempt')
+    parser.add_argument('--event-context', action='store_true', help='Track recent messages with a NewMessage event handler instead of fetching history before every send')
+    parser.add_argument('--refresh-stickers', action='store_true', help='Refresh all sticker file references before the first cycle')
+    parser.add_argument('--startup-profile', action='store_true', help='Print import time per module once the clients are connected')
+    parser.add_argument('--status-file', help='Where to write the periodic status summary (default: scraped_data/<user>/auto_chat_status/<pid>.json)')
     return parser.parse_args()
 
-async def try_connect_with_proxy(session_file, proxy_config, user_email):
+# 发送延迟、RPC次数、FloodWait和每个客户端的错误，输出为NDJSON事件和状态文件
+metrics = ChatMetrics()
+
+# 每个客户端缓存目标群组的InputPeer和自己的用户信息，出错时清除
+client_cache = {}
+
+async def get_cached_me(client):
+    """Get the client's own user, fetching it only once"""
+    cache = client_cache.setdefault(client, {})
+    if 'me' not in cache:
+        cache['me'] = await client.get_me()
+    return cache['me']
+
+async def get_cached_peer(client, target_group):
+    """Get the client's InputPeer for the target group, resolving it only once"""
+    cache = client_cache.setdefault(client, {})
+    if cache.get('target_group') != target_group or 'peer' not in cache:
+        cache['peer'] = await client.get_input_entity(target_group)
+        cache['target_group'] = target_group
+    return cache['peer']
+
+def invalidate_client_cache(client):
+    """Drop the cached entity and user of a client so they are resolved again"""
+    client_cache.pop(client, None)
+
+# 每个客户端已上传过的媒体：(发送方式, 路径, 大小, 修改时间) -> Telegram返回的Photo/Document
+# 文件引用和access_hash只对上传它的账号有效，所以按客户端分开保存
+upload_cache = {}
+
+async def send_media_file(client, channel, message, **kwargs):
+    """Send a media file, reusing the reference from an earlier upload of the same file"""
+    cache = upload_cache.setdefault(client, {})
+    key = (message.kind, message.media_path, message.media_size, message.media_mtime)
+    
+    cached = cache.get(key)
+    if cached is not None:
+        try:
+            sent = await client.send_file(channel, cached, **kwargs)
+            print(f"Reused uploaded media for {message.media_path}")
+            return sent
+        except Exception as e:
+            # 引用过期或被拒绝时删除缓存，重新上传
+            print(f"Cached media reference rejected, uploading again: {str(e)}")
+            cache.pop(key, None)
+    
+    sent = await client.send_file(channel, message.media_path, **kwargs)
+    media = getattr(sent, 'photo', None) or getattr(sent, 'document', None)
+    if media is not None:
+        cache[key] = media
+    return sent
+
+async def try_connect_with_proxy(session_file, proxy_config, user_email, timeout=DEFAULT_CONNECT_TIMEOUT):
     """Try to connect using specific proxy"""
+    # 统计RPC次数的TelegramClient子类
+    TelegramClient = metrics.metered_client_class()
+    
     client = None
     try:
         print(f"\nTrying to connect with session {session_file} using proxy {proxy_config['addr']}:{proxy_config['port']}")
@@ -104,20 +140,22 @@ async def try_connect_with_proxy(session_file, proxy_config, user_email):
         )
         
         print("Connecting to Telegram...")
-        await client.connect()
+        await asyncio.wait_for(client.connect(), timeout=timeout)
         
-        if not await client.is_user_authorized():
+        if not await asyncio.wait_for(client.is_user_authorized(), timeout=timeout):
             print(f"[FAILED] Session {session_file} is not authorized")
             await client.disconnect()
             return None
             
-        me = await client.get_me()
+        me = await asyncio.wait_for(client.get_me(), timeout=timeout)
+        client_cache[client] = {'me': me}
         print(f"[SUCCESS] Connected successfully with {session_file}")
         print(f"       Account: {me.first_name} (@{me.username})")
         return client
         
     except Exception as e:
-        print(f"[FAILED] Connection failed for {session_file} using proxy {proxy_config['addr']}: {str(e)}")
+        error = f"timed out after {timeout} seconds" if isinstance(e, asyncio.TimeoutError) else str(e)
+        print(f"[FAILED] Connection failed for {session_file} using proxy {proxy_config['addr']}: {error}")
         if client:
             try:
                 await client.disconnect()
@@ -125,7 +163,27 @@ async def try_connect_with_proxy(session_file, proxy_config, user_email):
                 pass
         return None
 
-async def init_clients(user_email):
+async def connect_session(session_file, user_email, semaphore, timeout=DEFAULT_CONNECT_TIMEOUT):
+    """Connect one session inside the concurrency limit, trying every proxy in turn"""
+    async with semaphore:
+        print(f"\nTrying to connect with session: {session_file}")
+        start_time = time.monotonic()
+        client = None
+        
+        # Try all proxies
+        for proxy in PROXY_CONFIGS:
+            client = await try_connect_with_proxy(session_file, proxy, user_email, timeout)
+            if client:
+                break
+        
+        elapsed = time.monotonic() - start_time
+        if client:
+            print(f"Connected {session_file} in {elapsed:.2f}s")
+        else:
+            print(f"Warning: {session_file} failed to connect with all proxies! ({elapsed:.2f}s)")
+        return client, elapsed
+
+async def init_clients(user_email, concurrency=DEFAULT_CONNECT_CONCURRENCY, timeout=DEFAULT_CONNECT_TIMEOUT):
     """Initialize all clients with proxy rotation"""
     try:
         # 构建用户特定的session目录
@@ -151,29 +209,28 @@ async def init_clients(user_email):
         print("\nTesting proxy configurations:")
         for i, proxy in enumerate(PROXY_CONFIGS):
             print(f" {i+1}. {proxy['proxy_type']}://{proxy['addr']}:{proxy['port']}")
-            
-        clients = []
-        successful_clients = 0
         
-        for session_file in session_files:
-            print(f"\nTrying to connect with session: {session_file}")
-            client = None
-            
-            # Try all proxies
-            for proxy in PROXY_CONFIGS:
-                client = await try_connect_with_proxy(session_file, proxy, user_email)
-                if client:
-                    clients.append(client)
-                    successful_clients += 1
-                    print(f"Successfully connected {successful_clients}/{len(session_files)} clients")
-                    break
-            
-            if not client:
-                print(f"Warning: {session_file} failed to connect with all proxies!")
+        # 并发连接所有session，每个session内部依次尝试代理
+        start_time = time.monotonic()
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        results = await asyncio.gather(*(
+            connect_session(session_file, user_email, semaphore, timeout)
+            for session_file in session_files
+        ))
+        total_elapsed = time.monotonic() - start_time
+        
+        clients = [client for client, _ in results if client]
+        successful_clients = len(clients)
+        
+        print("\nConnection times:")
+        for session_file, (client, elapsed) in zip(session_files, results):
+            print(f" - {session_file}: {elapsed:.2f}s ({'connected' if client else 'failed'})")
         
         print(f"\nClient initialization complete:")
         print(f"Total sessions: {len(session_files)}")
         print(f"Successful connections: {successful_clients}")
+        print(f"Startup time: {total_elapsed:.2f}s (concurrency {concurrency})")
+        metrics.startup(successful_clients, len(session_files), total_elapsed)
         
         return clients
         
@@ -184,6 +241,8 @@ async def init_clients(user_email):
         return []
 
 async def join_group(client, target_group):
+    from telethon.tl.functions.channels import JoinChannelRequest
+    
     try:
         print(f"Attempting to join group: {target_group}")
         await client(JoinChannelRequest(target_group))
@@ -191,10 +250,72 @@ async def join_group(client, target_group):
     except Exception as e:
         print(f"Failed to join group: {str(e)}")
 
+def get_message_topic_id(message):
+    """Get the forum topic a message belongs to, or None outside topics"""
+    reply_to = getattr(message, 'reply_to', None)
+    if reply_to and getattr(reply_to, 'forum_topic', False):
+        return reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+    return None
+
+class RecentMessageBuffer:
+    """Newest messages of the target group (and of each topic), fed by NewMessage events on one client"""
+
+    def __init__(self, target_group, size=5):
+        self.target_group = target_group
+        self.size = size
+        self.buffers = {}
+        self.client = None
+        self.handler = None
+
+    def add(self, message):
+        """Add a message to the group buffer and to its topic buffer"""
+        keys = [None]
+        topic_id = get_message_topic_id(message)
+        if topic_id:
+            keys.append(topic_id)
+        for key in keys:
+            self.buffers.setdefault(key, deque(maxlen=self.size)).append(message)
+
+    def get(self, topic_id=None):
+        """Get the buffered messages from oldest to newest"""
+        return list(self.buffers.get(topic_id, ()))
+
+    async def attach(self, client, topic_id=None):
+        """Start listening on a client, seeding the buffer with one history fetch"""
+        from telethon import events
+        
+        self.detach()
+        peer = await get_cached_peer(client, self.target_group)
+        
+        # 启动时拉取一次历史消息作为初始上下文，之后只靠事件更新
+        kwargs = {'reply_to': topic_id} if topic_id else {}
+        seeded = []
+        async for message in client.iter_messages(peer, limit=self.size, **kwargs):
+            seeded.append(message)
+        for message in reversed(seeded):
+            self.buffers.setdefault(None, deque(maxlen=self.size)).append(message)
+            if topic_id:
+                self.buffers.setdefault(topic_id, deque(maxlen=self.size)).append(message)
+        
+        async def on_new_message(event):
+            self.add(event.message)
+        
+        client.add_event_handler(on_new_message, events.NewMessage(chats=peer))
+        self.client = client
+        self.handler = on_new_message
+        print(f"Listening for new messages in {self.target_group} with client {client.session.filename}")
+
+    def detach(self):
+        """Stop listening on the current client"""
+        if self.client and self.handler:
+            self.client.remove_event_handler(self.handler)
+        self.client = None
+        self.handler = None
+
 async def get_recent_messages(client, target_group, limit=5, use_topic=False, topic_id=None):
     try:
         print(f"Getting recent messages - Group: {target_group}, Topic mode: {use_topic}, Topic ID: {topic_id}")
-        channel = await client.get_entity(target_group)
+        channel = await get_cached_peer(client, target_group)
         messages = []
         kwargs = {}
         if use_topic:
@@ -205,35 +326,167 @@ async def get_recent_messages(client, target_group, limit=5, use_topic=False, to
         return messages[::-1]  # Reverse message list
     except Exception as e:
         print(f"Failed to get messages: {str(e)}")
+        invalidate_client_cache(client)
         return []
 
-async def get_sticker_from_message(client, message_data, media_dir):
+@dataclass(slots=True)
+class PlannedMessage:
+    """A message source row compiled once into everything needed to send it"""
+    id: int
+    kind: str
+    content: str = None
+    media_file: str = None
+    media_path: str = None
+    media_size: int = 0
+    media_mtime: float = 0
+    sticker: dict = None
+
+def is_missing(value):
+    """Check for an empty CSV field (None, NaN or empty string) without pandas"""
+    return value is None or value != value or value == ''
+
+def resolve_media_path(media_file, media_dir):
+    """Resolve a media_file column value to an absolute path inside media_dir"""
+    # 获取media_file，确保不重复media路径
+    if media_file.startswith('media/') or media_file.startswith('media\\'):
+        # 移除开头的media/或media\
+        media_file = os.path.join(*os.path.normpath(media_file).split(os.path.sep)[1:])
+    return os.path.abspath(os.path.normpath(os.path.join(media_dir, media_file)))
+
+def load_legacy_sticker_info(media_path):
+    """Load a sticker reference from the per-sticker JSON file written by older scrapes"""
+    # 构建 JSON 文件路径 (将 .webp 替换为 .json)
+    json_path = os.path.splitext(media_path)[0] + '.json'
+    if not os.path.exists(json_path):
+        return None
+    with open(json_path, 'r') as f:
+        return json.load(f)
+
+def compile_message_plan(rows, media_dir, sticker_index=None):
+    """Compile message source rows once into a send plan, newest message first"""
+    sticker_index = sticker_index or {}
+    plan = []
+    skipped = 0
+    for row in rows:
+        kind = row.get('type')
+        content = None if is_missing(row.get('content')) else str(row['content'])
+        media_file = None if is_missing(row.get('media_file')) else str(row['media_file'])
+        
+        if kind in ['photo', 'file', 'sticker']:
+            if not media_file:
+                skipped += 1
+                continue
+            media_path = resolve_media_path(media_file, media_dir)
+            try:
+                stat = os.stat(media_path)
+            except OSError:
+                print(f"Warning: Media file not found, skipping: {media_path}")
+                skipped += 1
+                continue
+            planned = PlannedMessage(int(row['id']), kind, content, media_file, media_path, stat.st_size, stat.st_mtime)
+            if kind == 'sticker':
+                # 贴纸引用优先从索引读取，旧的消息源回退到单独的JSON文件
+                planned.sticker = sticker_index.get(str(planned.id)) or load_legacy_sticker_info(media_path)
+            plan.append(planned)
+        elif kind == 'text' and content:
+            plan.append(PlannedMessage(int(row['id']), kind, content))
+        else:
+            skipped += 1
+    
+    # 消息源从新到旧保存，发送时从最后一条开始
+    plan.reverse()
+    print(f"Compiled message plan: {len(plan)} sendable messages, {skipped} skipped")
+    return plan
+
+class StickerReferenceStore:
+    """Sticker references of the message plan, refreshed in bulk and written back to the sticker index"""
+
+    def __init__(self, plan, media_dir, source_group=None):
+        self.media_dir = media_dir
+        # 旧的消息源没有记录来源群组时，用消息源名称作为群组
+        self.source_group = source_group
+        self.stickers = [message for message in plan if message.sticker]
+
+    async def refresh(self, client, messages=None):
+        """Refresh stale file references of the given stickers (all stickers if None) and their sets"""
+        targets = messages if messages is not None else self.stickers
+        # 同一个贴纸包里的贴纸一起刷新
+        set_ids = {message.sticker['stickerset']['id'] for message in targets if message.sticker.get('stickerset')}
+        by_set = [message for message in self.stickers
+                  if message.sticker.get('stickerset') and message.sticker['stickerset']['id'] in set_ids]
+        refreshed = await self.refresh_from_sets(client, by_set)
+        # 没有贴纸包信息（旧消息源）或贴纸包里找不到的，按原消息重新获取
+        remaining = [message for message in targets if message.id not in refreshed]
+        refreshed.update(await self.refresh_from_messages(client, remaining))
+        
+        if refreshed:
+            update_sticker_index(self.media_dir, refreshed)
+        print(f"Refreshed {len(refreshed)} sticker references")
+        return refreshed
+
+    async def refresh_from_sets(self, client, messages):
+        """Refresh references by fetching each sticker set once"""
+        from telethon import types
+        from telethon.tl.functions.messages import GetStickerSetRequest
+        
+        refreshed = {}
+        sets = {}
+        for message in messages:
+            sets.setdefault(message.sticker['stickerset']['id'], []).append(message)
+        
+        for set_id, set_messages in sets.items():
+            stickerset = set_messages[0].sticker['stickerset']
+            try:
+                result = await client(GetStickerSetRequest(
+                    stickerset=types.InputStickerSetID(id=int(stickerset['id']), access_hash=int(stickerset['access_hash'])),
+                    hash=0
+                ))
+            except Exception as e:
+                print(f"Failed to fetch sticker set {set_id}: {str(e)}")
+                continue
+            documents = {document.id: document for document in result.documents}
+            for message in set_messages:
+                document = documents.get(int(message.sticker['id']))
+                if document:
+                    message.sticker.update(document_reference(document, 'sticker'))
+                    refreshed[message.id] = message.sticker
+        return refreshed
+
+    async def refresh_from_messages(self, client, messages):
+        """Refresh references by refetching the scraped source messages in batches of 100"""
+        refreshed = {}
+        chats = {}
+        for message in messages:
+            chat = message.sticker.get('chat') or self.source_group
+            if chat:
+                chats.setdefault(chat, []).append(message)
+        
+        for chat, chat_messages in chats.items():
+            for i in range(0, len(chat_messages), 100):
+                batch = {message.id: message for message in chat_messages[i:i + 100]}
+                try:
+                    source_messages = await client.get_messages(chat, ids=list(batch))
+                except Exception as e:
+                    print(f"Failed to refetch sticker messages from {chat}: {str(e)}")
+                    break
+                for source_message in source_messages:
+                    document = getattr(getattr(source_message, 'media', None), 'document', None) if source_message else None
+                    if document and document.id == int(batch[source_message.id].sticker['id']):
+                        sticker = batch[source_message.id].sticker
+                        sticker.update(document_reference(document, 'sticker'))
+                        refreshed[source_message.id] = sticker
+        return refreshed
+
+async def get_sticker_from_message(client, message, media_dir):
     """Get sticker object from message"""
+    from telethon import types
+    
     try:
-        media_file = message_data.get('media_file')
-        if not media_file or pd.isna(media_file):
+        sticker_info = message.sticker
+        if not sticker_info:
+            print(f"Sticker info not found for message {message.id}")
             return None
             
-        # 处理 media_file 路径，确保正确的格式
-        if media_file.startswith('media/'):
-            media_file = media_file[6:]  # 去掉 'media/' 前缀
-            
-        # 构建 JSON 文件路径 (将 .webp 替换为 .json)
-        base_name = os.path.splitext(media_file)[0]
-        json_path = os.path.join(media_dir, base_name + '.json')
-        
-        print(f"\nDebug sticker info:")
-        print(f"Looking for sticker info at: {json_path}")
-        
-        if not os.path.exists(json_path):
-            print(f"Sticker info not found: {json_path}")
-            return None
-            
-        # 加载 sticker 信息
-        with open(json_path, 'r') as f:
-            sticker_info = json.load(f)
-            print(f"Loaded sticker info: {sticker_info}")
-            
         # 创建 InputDocument
         input_doc = types.InputDocument(
             id=int(sticker_info['id']),
@@ -248,19 +501,29 @@ async def get_sticker_from_message(client, message_data, media_dir):
         traceback.print_exc()
     return None
 
-async def process_message(client, message_data, target_group, recent_messages, topic_id=None, media_dir=None):
+def is_file_reference_error(error):
+    """Check whether an error means a stored file reference is no longer valid"""
+    from telethon.errors import FileReferenceExpiredError
+    
+    return isinstance(error, FileReferenceExpiredError) or 'FILE_REFERENCE' in str(error)
+
+async def process_message(client, message, target_group, recent_messages, topic_id=None, media_dir=None,
+                          sticker_store=None):
     """Process a single message"""
+    from telethon import types
+    from telethon.tl.functions.messages import SendReactionRequest
+    
     try:
         print(f"\nProcessing message data:")
-        print(f"Type: {message_data['type']}")
-        print(f"Content: {message_data['content'][:50]}..." if not pd.isna(message_data['content']) else "No content")
-        print(f"Media file: {message_data['media_file']}" if not pd.isna(message_data['media_file']) else "No media")
+        print(f"Type: {message.kind}")
+        print(f"Content: {message.content[:50]}..." if message.content else "No content")
+        print(f"Media file: {message.media_path} ({message.media_size} bytes)" if message.media_path else "No media")
         print(f"Topic ID: {topic_id}")
         
-        # 获取目标群组实体
+        # 获取目标群组实体（已缓存）
         try:
-            channel = await client.get_entity(target_group)
-            print(f"Successfully got channel entity: {channel.title}")
+            channel = await get_cached_peer(client, target_group)
+            print(f"Using channel entity for {target_group}")
         except Exception as e:
             print(f"Failed to get channel entity: {str(e)}")
             raise
@@ -289,9 +552,9 @@ async def process_message(client, message_data, target_group, recent_messages, t
                 await client(SendReactionRequest(
                     peer=channel,
                     msg_id=target_message.id,
-                    reaction=[ReactionEmoji(emoticon=reaction)]
+                    reaction=[types.ReactionEmoji(emoticon=reaction)]
                 ))
-                me = await client.get_me()
+                me = await get_cached_me(client)
                 print(f"[{me.first_name}] Successfully reacted with {reaction}")
                 return
             except Exception as e:
@@ -299,112 +562,88 @@ async def process_message(client, message_data, target_group, recent_messages, t
                 traceback.print_exc()
             return
             
-        # 发送消息（包括普通发送和回复）
-        if message_data['type'] in ['photo', 'file', 'sticker']:
-            print(f"\nProcessing media message:")
-            print(f"Media directory: {media_dir}")
-            print(f"Media type: {message_data['type']}")
-            
-            # 检查media_file是否为空或NaN
-            if pd.isna(message_data['media_file']):
-                print("Warning: media_file is NaN")
-                return
-                
-            # 获取media_file，确保不重复media路径
-            media_file = message_data['media_file']
-            if media_file.startswith('media/') or media_file.startswith('media\\'):
-                # 移除开头的media/或media\
-                media_file = os.path.join(*os.path.normpath(media_file).split(os.path.sep)[1:])
-                
-            # 构建完整路径
-            media_path = os.path.normpath(os.path.join(media_dir, media_file))
-            print(f"Full media path: {media_path}")
-            print(f"File exists: {os.path.exists(media_path)}")
-            
-            if os.path.exists(media_path):
-                # 检查文件扩展名
-                file_ext = os.path.splitext(media_path)[1].lower()
-                print(f"File extension: {file_ext}")
-                
-                if message_data['type'] == 'sticker':
-                    print("Processing sticker...")
-                    # 尝试使用 sticker ID 发送
-                    sticker = await get_sticker_from_message(client, message_data, media_dir)
-                    if sticker:
-                        try:
-                            print(f"Got sticker ID: {sticker.id}")
-                            # 创建 InputMediaDocument
-                            media = types.InputMediaDocument(
-                                id=sticker,
-                                ttl_seconds=None,
-                                spoiler=False
-                            )
-                            
-                            # 使用 send_media 发送 sticker
-                            await client.send_message(
-                                channel,
-                                message="",  # 空消息文本
-                                file=media,  # 使用 media 参数
-                                **kwargs
-                            )
-                            print(f"Successfully sent sticker using ID: {sticker.id}")
-                            return
-                        except Exception as e:
-                            print(f"Failed to send sticker using ID: {str(e)}")
-                            traceback.print_exc()
-                    
-                    # 如果使用 ID 发送失败，尝试直接发送文件
-                    print("Falling back to sending sticker as file...")
-                    try:
-                        await client.send_file(
-                            channel,
-                            media_path,
-                            force_document=True,  # 强制作为文档发送
-                            **kwargs
-                        )
-                        print(f"Successfully sent sticker as file: {media_path}")
-                        return
-                    except Exception as e:
-                        print(f"Failed to send sticker as file: {str(e)}")
-                        traceback.print_exc()
-                        return
-                        
-                elif message_data['type'] == 'photo':
-                    print("Sending photo...")
-                    await client.send_file(
-                        channel,
-                        media_path,
-                        **kwargs
+        # 发送消息（包括普通发送和回复）；媒体路径在编译消息计划时已经解析并检查过
+        media_path = message.media_path
+        if message.kind == 'sticker':
+            print("Processing sticker...")
+            # 尝试使用 sticker ID 发送，文件引用过期时批量刷新后再试一次
+            for attempt in range(2):
+                sticker = await get_sticker_from_message(client, message, media_dir)
+                if not sticker:
+                    break
+                try:
+                    print(f"Got sticker ID: {sticker.id}")
+                    # 创建 InputMediaDocument
+                    media = types.InputMediaDocument(
+                        id=sticker,
+                        ttl_seconds=None,
+                        spoiler=False
                     )
-                    print("Successfully sent photo")
-                else:  # file
-                    print("Sending file...")
-                    await client.send_file(
+                    
+                    # 使用 send_media 发送 sticker
+                    await client.send_message(
                         channel,
-                        media_path,
+                        message="",  # 空消息文本
+                        file=media,  # 使用 media 参数
                         **kwargs
                     )
-                    print("Successfully sent file")
-            else:
-                print(f"Error: Media file not found: {media_path}")
-                print(f"Current working directory: {os.getcwd()}")
+                    print(f"Successfully sent sticker using ID: {sticker.id}")
+                    return
+                except Exception as e:
+                    print(f"Failed to send sticker using ID: {str(e)}")
+                    if attempt == 0 and sticker_store and is_file_reference_error(e):
+                        print("Sticker file reference expired, refreshing...")
+                        if message.id in await sticker_store.refresh(client, [message]):
+                            continue
+                    traceback.print_exc()
+                    break
+            
+            # 如果使用 ID 发送失败，尝试直接发送文件
+            print("Falling back to sending sticker as file...")
+            try:
+                await send_media_file(
+                    client,
+                    channel,
+                    message,
+                    force_document=True,  # 强制作为文档发送
+                    **kwargs
+                )
+                print(f"Successfully sent sticker as file: {media_path}")
                 return
-                
-        elif message_data['type'] == 'text':
-            print("Sending text message...")
-            if pd.isna(message_data['content']):
-                print("Error: Message content is empty")
+            except Exception as e:
+                print(f"Failed to send sticker as file: {str(e)}")
+                traceback.print_exc()
                 return
                 
+        elif message.kind == 'photo':
+            print("Sending photo...")
+            await send_media_file(
+                client,
+                channel,
+                message,
+                **kwargs
+            )
+            print("Successfully sent photo")
+        elif message.kind == 'file':
+            print("Sending file...")
+            await send_media_file(
+                client,
+                channel,
+                message,
+                **kwargs
+            )
+            print("Successfully sent file")
+        elif message.kind == 'text':
+            print("Sending text message...")
             await client.send_message(
                 channel,
-                message_data['content'],
+                message.content,
                 **kwargs
             )
             print("Successfully sent text message")
             
-        me = await client.get_me()
-        content_preview = message_data['content'][:50] if not pd.isna(message_data['content']) else "[Media message]"
+        me = await get_cached_me(client)
+        content_preview = message.content[:50] if message.content else "[Media message]"
         print(f"[{me.first_name}] Successfully sent message: {content_preview}...")
         
     except Exception as e:
@@ -412,7 +651,7 @@ async def process_message(client, message_data, target_group, recent_messages, t
         traceback.print_exc()
         raise  # 重新抛出异常，让上层函数处理
 
-async def run_chat_loop(clients, df, args, media_dir):
+async def run_chat_loop(clients, plan, args, media_dir, sticker_store=None):
     """运行主聊天循环"""
     print("\nStarting chat loop...")
     
@@ -420,10 +659,12 @@ async def run_chat_loop(clients, df, args, media_dir):
         print("Error: No clients available")
         return
         
-    if df.empty:
-        print("Error: No messages to send (DataFrame is empty)")
+    if not plan:
+        print("Error: No messages to send (message plan is empty)")
         return
         
+    status_writer = None
+    finished = False
     try:
         # 获取目标群组
         target_group = args.target_group
@@ -435,66 +676,103 @@ async def run_chat_loop(clients, df, args, media_dir):
             try:
                 await join_group(client, target_group)
                 print(f"Successfully joined group with client {client.session.filename}")
+                # 加入后一次性解析目标群组和自己的用户信息
+                await get_cached_peer(client, target_group)
+                await get_cached_me(client)
                 active_clients.append(client)
             except Exception as e:
                 print(f"Error joining group with client {client.session.filename}: {str(e)}")
+                metrics.client_error(client, e)
                 continue
                 
         if not active_clients:
             print("Error: No clients could join the target group")
             return
+        
+        # 事件模式：一个客户端监听新消息，发送前不再拉取历史
+        topic_id = args.topic_id if args.topic else None
+        recent_buffer = None
+        if args.event_context:
+            recent_buffer = RecentMessageBuffer(target_group)
+            try:
+                await recent_buffer.attach(active_clients[0], topic_id)
+            except Exception as e:
+                print(f"Failed to start message listener, falling back to fetching history: {str(e)}")
+                recent_buffer = None
+        
+        # 启动时批量刷新贴纸引用，避免发送时逐个过期
+        if sticker_store and args.refresh_stickers and sticker_store.stickers:
+            try:
+                await sticker_store.refresh(active_clients[0])
+            except Exception as e:
+                print(f"Error refreshing sticker references: {str(e)}")
             
+        # 定期写状态文件，等待发送间隔时也能看到进程仍在运行
+        metrics.write_status()
+        status_writer = asyncio.create_task(metrics.run_status_writer())
+        
         while True:  # 添加外部循环
             print("\n=== Starting new message cycle ===")
-            # 反转DataFrame的顺序，从最后一条开始发送
-            df_current = df.iloc[::-1].reset_index(drop=True)
-            
+            # 消息计划在加载时已经编译好，每一轮直接复用
             print(f"\nStarting message loop with {len(active_clients)} active clients")
-            print(f"Total messages to send: {len(df_current)}")
+            print(f"Total messages to send: {len(plan)}")
             print("Messages will be sent from newest to oldest")
             
             # 开始消息循环
             message_count = 0
-            for index, row in df_current.iterrows():
+            for index, message in enumerate(plan):
                 try:
                     # 随机选择一个客户端
                     client = random.choice(active_clients)
-                    me = await client.get_me()
-                    print(f"\nProcessing message {index + 1}/{len(df_current)} (from newest)")
+                    me = await get_cached_me(client)
+                    print(f"\nProcessing message {index + 1}/{len(plan)} (from newest)")
                     print(f"Using client: {me.username} ({client.session.filename})")
                     
                     # 获取最近消息用于上下文
-                    try:
-                        recent_messages = await get_recent_messages(
-                            client, 
-                            target_group,
-                            use_topic=args.topic,
-                            topic_id=args.topic_id
-                        )
-                        print(f"Retrieved {len(recent_messages)} recent messages for context")
-                    except Exception as e:
-                        print(f"Error getting recent messages: {str(e)}")
-                        recent_messages = []
+                    if recent_buffer:
+                        # 监听的客户端被移除后换一个客户端继续监听
+                        if recent_buffer.client not in active_clients:
+                            try:
+                                await recent_buffer.attach(active_clients[0], topic_id)
+                            except Exception as e:
+                                print(f"Error moving message listener: {str(e)}")
+                        recent_messages = recent_buffer.get(topic_id)
+                        print(f"Using {len(recent_messages)} buffered recent messages for context")
+                    else:
+                        try:
+                            recent_messages = await get_recent_messages(
+                                client, 
+                                target_group,
+                                use_topic=args.topic,
+                                topic_id=args.topic_id
+                            )
+                            print(f"Retrieved {len(recent_messages)} recent messages for context")
+                        except Exception as e:
+                            print(f"Error getting recent messages: {str(e)}")
+                            recent_messages = []
                     
-                    # 检查消息数据
-                    if pd.isna(row['content']) and pd.isna(row['media']):
-                        print("Warning: Empty message data, skipping...")
-                        continue
-                        
                     # 处理并发送消息
+                    send_started = time.perf_counter()
+                    rpc_before = metrics.rpc_count(client)
                     try:
                         await process_message(
                             client,
-                            row,
+                            message,
                             target_group,
                             recent_messages,
-                            topic_id=args.topic_id if args.topic else None,
-                            media_dir=media_dir
+                            topic_id=topic_id,
+                            media_dir=media_dir,
+                            sticker_store=sticker_store
                         )
                         message_count += 1
                         print(f"Successfully sent message {message_count}")
+                        metrics.message_sent(client, index, message, time.perf_counter() - send_started,
+                                             metrics.rpc_count(client) - rpc_before)
                     except Exception as e:
                         print(f"Error processing message: {str(e)}")
+                        metrics.message_failed(client, index, message, time.perf_counter() - send_started,
+                                               metrics.rpc_count(client) - rpc_before, e)
+                        invalidate_client_cache(client)
                         # 如果是认证错误，从活动客户端列表中移除
                         if "auth" in str(e).lower():
                             print(f"Removing client {client.session.filename} due to auth error")
@@ -514,10 +792,12 @@ async def run_chat_loop(clients, df, args, media_dir):
                     continue
             
             print(f"\nMessage cycle completed. Sent {message_count} messages successfully.")
+            metrics.cycle_complete(message_count)
             
             # 检查是否启用了循环
             if not args.enable_loop:
                 print("Loop mode not enabled, exiting...")
+                finished = True
                 break
                 
             print("\nLoop mode enabled, waiting before starting next cycle...")
@@ -528,12 +808,34 @@ async def run_chat_loop(clients, df, args, media_dir):
         print(f"Fatal error in chat loop: {str(e)}")
         import traceback
         traceback.print_exc()
+    finally:
+        if status_writer:
+            status_writer.cancel()
+        metrics.write_status(running=False)
+        if finished:
+            # 正常结束时删除状态文件，避免在用户目录里越积越多；出错时保留给状态接口查看
+            metrics.remove_status()
+        # 客户端不会断开，在这里保存学到的请求间隔
+        rate_controller.save_all()
 
 async def main():
+    session_claim = None
+    claim_keeper = None
     try:
         # Parse command line arguments
         args = parse_args()
         
+        # 每次运行一个状态文件，放在单独的子目录里，不和用户目录下的测试记录混在一起
+        metrics.status_file = args.status_file or os.path.join(
+            args.root_dir, 'scraped_data', args.user_email, 'auto_chat_status', f'{os.getpid()}.json'
+        )
+        # 先写一次状态，连接session期间状态接口也能确认进程在运行
+        metrics.write_status()
+        # 声明占用这个用户的session，运行期间worker不会再连接它们
+        session_claim = SessionClaim(os.path.join(SESSIONS_DIR, args.user_email))
+        session_claim.write()
+        claim_keeper = asyncio.create_task(session_claim.keep_alive())
+        
         print("\n=== Starting Auto Chat ===")
         print(f"Target group: {args.target_group}")
         print(f"Is topic group: {args.topic}")
@@ -544,23 +846,24 @@ async def main():
         print(f"User email: {args.user_email}")
         print(f"Loop mode: {args.enable_loop}")
         
-        # 检查消息源文件
-        message_source_path = os.path.join(
+        
+        # 检查消息源文件（优先使用Parquet，没有时回退到CSV）
+        message_source_dir = os.path.join(
             args.root_dir,
             'scraped_data',
             args.user_email,
-            args.message_source,
-            f"{args.message_source}_messages.csv"
+            args.message_source
         )
+        message_source_path, parquet_path = get_source_paths(message_source_dir, args.message_source)
         print(f"\nChecking message source file: {message_source_path}")
         
-        if not os.path.exists(message_source_path):
+        if not os.path.exists(message_source_path) and not os.path.exists(parquet_path):
             print(f"Error: Message source file not found: {message_source_path}")
             sys.exit(1)
             
         try:
-            df = pd.read_csv(message_source_path)
-            print(f"Successfully loaded message source file. Found {len(df)} messages.")
+            rows, loaded_path = load_message_source(message_source_dir, args.message_source)
+            print(f"Successfully loaded message source file {loaded_path}. Found {len(rows)} messages.")
         except Exception as e:
             print(f"Error reading message source file: {str(e)}")
             sys.exit(1)
@@ -587,20 +890,33 @@ async def main():
             print(f"Creating media directory: {media_dir}")
             os.makedirs(media_dir, exist_ok=True)
         
+        # 一次性编译消息计划：解析媒体路径、检查文件、确定发送方式
+        plan = compile_message_plan(rows, media_dir, load_sticker_index(media_dir))
+        sticker_store = StickerReferenceStore(plan, media_dir, args.message_source)
+        
+        try:
+            import telethon  # noqa: F401
+        except ImportError as e:
+            print(f"Failed to import Telethon: {str(e)}")
+            print("Please install it using: pip install -r requirements.txt")
+            sys.exit(1)
+        
         try:
             # 初始化客户端
             print("\nInitializing Telegram clients...")
-            clients = await init_clients(args.user_email)
+            clients = await init_clients(args.user_email, args.connect_concurrency, args.connect_timeout)
             
             if not clients:
                 print("Error: No valid clients found")
                 sys.exit(1)
                 
             print(f"Successfully initialized {len(clients)} clients")
+            if args.startup_profile:
+                startup_profile.report()
             
             # 运行主循环
             print("\nStarting chat loop...")
-            await run_chat_loop(clients, df, args, media_dir)
+            await run_chat_loop(clients, plan, args, media_dir, sticker_store)
             
         except Exception as e:
             print(f"Error in main function: {str(e)}")
@@ -613,8 +929,15 @@ async def main():
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if claim_keeper:
+            claim_keeper.cancel()
+        if session_claim:
+            session_claim.remove()
 
 if __name__ == "__main__":
+    # Set UTF-8 as default encoding for stdout
+    sys.stdout.reconfigure(encoding='utf-8')
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
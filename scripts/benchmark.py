@@ -0,0 +1,352 @@
+"""
+Benchmarks of the scripts against the offline fake backend in fake_telegram.py
+
+Measures scrape_group throughput, test_session fan-out, init_clients startup,
+the per-message overhead of run_chat_loop and the message source load time
+(CSV against Parquet), and writes the results to a
+JSON file. Pass --compare with an earlier results file to print the change
+of every metric.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output bench.json --compare bench_old.json --latency 0.05
+"""
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+
+from fake_telegram import FakeTelegram
+from rate_control import paced_client_class
+from message_source import CSV_FIELDS, get_source_paths, parquet_available, write_parquet, load_message_source
+
+BENCHMARKS = ['scrape', 'test_sessions', 'init_clients', 'chat_loop', 'load_source']
+BENCH_USER = 'bench@example.com'
+BENCH_GROUP = 'bench_group'
+# 加载消息源的重复次数，取最快的一次
+LOAD_REPEATS = 5
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against a fake Telegram backend')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='Run only these benchmarks')
+    parser.add_argument('--messages', type=int, default=2000, help='Size of the synthetic group history')
+    parser.add_argument('--media-pool', type=int, default=200, help='Number of distinct media files in the history')
+    parser.add_argument('--media-size', type=int, default=20000, help='Size of each media file in bytes')
+    parser.add_argument('--sessions', type=int, default=50, help='Number of session files to test and connect')
+    parser.add_argument('--unauthorized', type=int, default=5, help='How many of the sessions are not authorized')
+    parser.add_argument('--chat-messages', type=int, default=200, help='Number of messages run_chat_loop sends')
+    parser.add_argument('--latency', type=float, default=0.02, help='Injected latency of every RPC in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- variation of the latency in seconds')
+    parser.add_argument('--connect-latency', type=float, default=0.1, help='Injected latency of connect() in seconds')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Download/upload bandwidth in bytes/s (0 = unlimited)')
+    parser.add_argument('--flood-wait-rate', type=float, default=0.0, help='Share of RPCs that raise FloodWaitError')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Requests per second per session and method before FloodWaitError (0 = no limit)')
+    parser.add_argument('--no-pacing', action='store_true', help='Bypass the shared rate controller (raw fake client)')
+    parser.add_argument('--export', action='store_true', help='Run the scrape benchmark in export (takeout) mode')
+    parser.add_argument('--concurrency', type=int, default=10, help='Concurrency passed to test_sessions and init_clients')
+    parser.add_argument('--media-concurrency', type=int, default=4, help='Media download concurrency of scrape_group')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data and the random choices')
+    return parser.parse_args()
+
+
+def make_backend(args):
+    """Fake backend with the latency and FloodWait settings from the command line"""
+    backend = FakeTelegram(
+        latency=args.latency,
+        jitter=args.jitter,
+        connect_latency=args.connect_latency,
+        flood_wait_rate=args.flood_wait_rate,
+        rate_limit=args.rate_limit or None,
+        bandwidth=args.bandwidth or None,
+        unauthorized={f"bench{i}.session" for i in range(args.unauthorized)},
+        seed=args.seed
+    )
+    backend.add_group(BENCH_GROUP, args.messages, media_pool=args.media_pool, media_size=args.media_size)
+    return backend
+
+
+def client_class(args, backend):
+    """Client class the scripts get: the fake client behind the rate controller, like the real one"""
+    fake_client = backend.client_class()
+    return fake_client if args.no_pacing else paced_client_class(fake_client)
+
+
+def check_pacing(args, backend):
+    """Fail the benchmark if a paced client slept out FloodWaits itself instead of the rate controller"""
+    if not args.no_pacing and backend.flood_waits_slept:
+        raise Exception(f"{backend.flood_waits_slept} of {backend.flood_waits} FloodWaits were slept by the client "
+                        f"and never reached the rate controller")
+
+
+def make_sessions(sessions_dir, count):
+    """Create empty session files (the fake client never reads them)"""
+    os.makedirs(sessions_dir, exist_ok=True)
+    for i in range(count):
+        open(os.path.join(sessions_dir, f"bench{i}.session"), 'w').close()
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide the progress output of the scripts while measuring"""
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            yield
+
+
+async def bench_scrape(args, work_dir):
+    """scrape_group throughput: a full scrape, then a rescrape that reuses the stored media"""
+    import scrape_messages
+
+    backend = make_backend(args)
+    scrape_messages.DATA_DIR = os.path.join(work_dir, 'scraped_data')
+    client = client_class(args, backend)(os.path.join(work_dir, 'scraper'))
+    await client.connect()
+
+    result = {'messages': args.messages}
+    for run in ['first', 'rescrape']:
+        calls_before = backend.stats()['rpc']
+        start_time = time.perf_counter()
+        with quiet():
+            async with scrape_messages.open_export_session(client, args.export) as (scrape_client, takeout):
+                await scrape_messages.scrape_group(scrape_client, BENCH_GROUP, args.messages, BENCH_USER,
+                                                   media_concurrency=args.media_concurrency, takeout=takeout)
+        elapsed = time.perf_counter() - start_time
+        result[f"{run}Seconds"] = round(elapsed, 3)
+        result[f"{run}MessagesPerSecond"] = round(args.messages / elapsed, 1)
+        result[f"{run}Rpc"] = backend.stats()['rpc'] - calls_before
+    result['downloads'] = backend.calls['GetFileRequest']
+    result['bytesDownloaded'] = backend.bytes_downloaded
+    result['floodWaits'] = backend.flood_waits
+    check_pacing(args, backend)
+    return result
+
+
+async def bench_test_sessions(args, work_dir):
+    """test_session fan-out: check every session file the way test_sessions.py main does"""
+    import test_sessions
+
+    backend = make_backend(args)
+    test_sessions.TelegramClient = client_class(args, backend)
+    sessions_dir = os.path.join(work_dir, 'test_sessions')
+    make_sessions(sessions_dir, args.sessions)
+    session_files = sorted(f for f in os.listdir(sessions_dir) if f.endswith('.session'))
+
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+    start_time = time.perf_counter()
+    with quiet():
+        results = await asyncio.gather(*(
+            test_sessions.test_session_with_timeout(os.path.join(sessions_dir, f), semaphore, test_sessions.DEFAULT_TIMEOUT)
+            for f in session_files
+        ))
+    elapsed = time.perf_counter() - start_time
+    check_pacing(args, backend)
+    return {
+        'sessions': len(session_files),
+        'concurrency': args.concurrency,
+        'seconds': round(elapsed, 3),
+        'perSessionMs': round(elapsed / len(session_files) * 1000, 2),
+        'valid': sum(1 for r in results if r['status'] == 'valid'),
+        'rpc': backend.stats()['rpc']
+    }
+
+
+async def connect_clients(args, backend, work_dir):
+    """Run auto_chat.init_clients against the fake backend; returns (clients, seconds)"""
+    with quiet():
+        # auto_chat在导入时打印启动信息
+        import auto_chat
+
+    auto_chat.SESSIONS_DIR = os.path.join(work_dir, 'sessions')
+    if args.no_pacing:
+        auto_chat.metrics.client_class = backend.client_class()
+    else:
+        # 和auto_chat一样经过计数和限速，FloodWait由限速器回调计入指标
+        auto_chat.metrics.client_class = None
+        auto_chat.metrics.metered_client_class(backend.client_class())
+    make_sessions(os.path.join(auto_chat.SESSIONS_DIR, BENCH_USER), args.sessions)
+
+    start_time = time.perf_counter()
+    with quiet():
+        clients = await auto_chat.init_clients(BENCH_USER, args.concurrency)
+    return clients, time.perf_counter() - start_time
+
+
+async def bench_init_clients(args, work_dir):
+    """init_clients startup: connect every session of a user"""
+    backend = make_backend(args)
+    clients, elapsed = await connect_clients(args, backend, work_dir)
+    check_pacing(args, backend)
+    return {
+        'sessions': args.sessions,
+        'concurrency': args.concurrency,
+        'seconds': round(elapsed, 3),
+        'connected': len(clients),
+        'rpc': backend.stats()['rpc']
+    }
+
+
+async def bench_chat_loop(args, work_dir):
+    """run_chat_loop per-message overhead: one pass over a plan built from a scraped message source"""
+    import scrape_messages
+    with quiet():
+        import auto_chat
+    from message_source import load_sticker_index
+
+    backend = make_backend(args)
+    scrape_messages.DATA_DIR = os.path.join(work_dir, 'chat_source')
+    scraper = client_class(args, backend)(os.path.join(work_dir, 'scraper'))
+    with quiet():
+        csv_file = await scrape_messages.scrape_group(scraper, BENCH_GROUP, args.chat_messages, BENCH_USER,
+                                                      media_concurrency=args.media_concurrency)
+    rows, _ = auto_chat.load_message_source(os.path.dirname(csv_file), BENCH_GROUP)
+    media_dir = os.path.join(os.path.dirname(csv_file), 'media')
+
+    clients, _ = await connect_clients(args, backend, work_dir)
+    with quiet():
+        plan = auto_chat.compile_message_plan(rows, media_dir, load_sticker_index(media_dir))
+    loop_args = argparse.Namespace(
+        target_group=BENCH_GROUP, topic=False, topic_id=None, min_interval=0, max_interval=0,
+        enable_loop=False, event_context=False, refresh_stickers=False
+    )
+
+    calls_before = backend.stats()['rpc']
+    sent_before = backend.sent
+    waits_before = backend.flood_waits
+    counted_before = auto_chat.metrics.flood_waits
+    start_time = time.perf_counter()
+    with quiet():
+        await auto_chat.run_chat_loop(clients, plan, loop_args, media_dir)
+    elapsed = time.perf_counter() - start_time
+    rpc = backend.stats()['rpc'] - calls_before
+    waits = backend.flood_waits - waits_before
+    counted = auto_chat.metrics.flood_waits - counted_before
+    if not args.no_pacing and counted < waits:
+        # 被客户端自己睡眠消化的FloodWait既不计数，睡眠时间还被算进发送延迟
+        raise Exception(f"chat metrics counted {counted} of {waits} FloodWaits")
+    check_pacing(args, backend)
+    return {
+        'messages': len(plan),
+        'sent': backend.sent - sent_before,
+        'seconds': round(elapsed, 3),
+        'perMessageMs': round(elapsed / len(plan) * 1000, 2) if plan else None,
+        # 固定延迟之外的开销：总时间减去所有RPC的注入延迟
+        'overheadPerMessageMs': round((elapsed - rpc * args.latency) / len(plan) * 1000, 2) if plan else None,
+        'rpcPerMessage': round(rpc / len(plan), 2) if plan else None,
+        'floodWaits': backend.flood_waits
+    }
+
+
+def best_time(fn, repeats=LOAD_REPEATS):
+    """Fastest of several runs of fn in seconds"""
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+async def bench_load_source(args, work_dir):
+    """load_message_source: the CSV against its Parquet copy (if pyarrow is installed)"""
+    backend = make_backend(args)
+    group = backend.group(BENCH_GROUP)
+    csv_file, parquet_file = get_source_paths(work_dir, BENCH_GROUP)
+    with open(csv_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for message in sorted(group.messages.values(), key=lambda m: -m.id):
+            writer.writerow({
+                'id': message.id,
+                'date': message.date.isoformat(),
+                'type': message.kind,
+                'content': message.text if message.kind == 'text' else '',
+                'media_file': f"media/{message.kind}_{message.id}" if message.kind != 'text' else ''
+            })
+
+    result = {'rows': len(group.messages), 'csvMs': round(best_time(lambda: load_message_source(work_dir, BENCH_GROUP)) * 1000, 2)}
+    if parquet_available():
+        write_parquet(csv_file, parquet_file)
+        result['parquetMs'] = round(best_time(lambda: load_message_source(work_dir, BENCH_GROUP)) * 1000, 2)
+        result['speedup'] = round(result['csvMs'] / result['parquetMs'], 2) if result['parquetMs'] else None
+    return result
+
+
+def git_commit():
+    """Current commit of the repository, if available"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare_results(old, new):
+    """Print every numeric metric next to its value in an earlier run"""
+    print(f"\nCompared with {old.get('commit')} ({old.get('timestamp')}):")
+    for name, metrics in new['results'].items():
+        old_metrics = old.get('results', {}).get(name) or {}
+        for key, value in metrics.items():
+            old_value = old_metrics.get(key)
+            if isinstance(value, (int, float)) and isinstance(old_value, (int, float)) and old_value:
+                change = (value - old_value) / old_value * 100
+                print(f" {name}.{key}: {old_value} -> {value} ({change:+.1f}%)")
+
+
+async def main():
+    args = parse_args()
+    random.seed(args.seed)
+    selected = args.only or BENCHMARKS
+    benchmarks = {
+        'scrape': bench_scrape,
+        'test_sessions': bench_test_sessions,
+        'init_clients': bench_init_clients,
+        'chat_loop': bench_chat_loop,
+        'load_source': bench_load_source
+    }
+
+    results = {}
+    for name in selected:
+        work_dir = tempfile.mkdtemp(prefix=f"tg_bench_{name}_")
+        try:
+            print(f"Running {name}...")
+            results[name] = await benchmarks[name](args, work_dir)
+            print(f" {json.dumps(results[name])}")
+        except Exception as e:
+            print(f" {name} failed: {str(e)}")
+            results[name] = {'error': str(e)}
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'timestamp': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'only')},
+        'results': results
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_results(json.load(f), output)
+
+
+if __name__ == '__main__':
+    if os.name == 'nt':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(main())
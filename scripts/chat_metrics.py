@@ -0,0 +1,196 @@
+"""
+Structured metrics for auto_chat.py
+
+Events are printed as one JSON object per line with a 'type' key, like the
+progress events of scrape_messages.py, so they can be picked out of the
+free-form log. A summary snapshot is also written to a status file that the
+/api/auto-chat/status route reads.
+"""
+import os
+import json
+import time
+import asyncio
+from collections import Counter, deque
+from datetime import datetime
+from rate_control import paced_client_class, rate_controller
+
+# 状态文件的写入间隔（秒）
+STATUS_INTERVAL = 30
+# 计算延迟分位数时保留的最近消息数
+LATENCY_WINDOW = 200
+
+
+def client_label(client):
+    """Short name of a client for metrics (its session file name)"""
+    return os.path.basename(client.session.filename)
+
+
+class ChatMetrics:
+    """Counters and latencies of one auto chat run"""
+
+    def __init__(self, status_file=None):
+        self.status_file = status_file
+        self.started_at = time.time()
+        self.sent = 0
+        self.failed = 0
+        self.cycle = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.rpc_total = 0
+        self.rpc_by_request = Counter()
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.clients = {}
+        self.client_class = None
+
+    def emit(self, event_type, **fields):
+        """Print one NDJSON event"""
+        print(json.dumps({'type': event_type, 'timestamp': datetime.now().isoformat(), **fields}, ensure_ascii=False),
+              flush=True)
+
+    def client_stats(self, label):
+        """Counters of one client, created on first use"""
+        return self.clients.setdefault(label, {'sent': 0, 'errors': 0, 'rpc': 0, 'floodWaits': 0, 'lastError': None})
+
+    def metered_client_class(self, base=None):
+        """Paced TelegramClient (or base) subclass that counts every RPC it sends"""
+        if self.client_class is None:
+            metrics = self
+
+            class MeteredTelegramClient(paced_client_class(base)):
+                async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+                    metrics.count_rpc(self, request)
+                    return await super().__call__(request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+
+            self.client_class = MeteredTelegramClient
+            # 限速器等待后重试的FloodWait不会抛给调用方，由回调计数
+            rate_controller.listeners.append(self.paced_flood_wait)
+        return self.client_class
+
+    def paced_flood_wait(self, client, seconds, request_name, slept):
+        """Count a FloodWait the rate controller waited out (raised ones are counted by client_error)"""
+        if slept:
+            self.flood_wait(client, seconds, request_name, slept=True)
+
+    def count_rpc(self, client, request):
+        """Count one RPC sent by a client"""
+        requests = request if isinstance(request, (list, tuple)) else [request]
+        self.rpc_total += len(requests)
+        for r in requests:
+            self.rpc_by_request[type(r).__name__] += 1
+        self.client_stats(client_label(client))['rpc'] += len(requests)
+
+    def rpc_count(self, client):
+        """RPCs sent by a client so far"""
+        return self.client_stats(client_label(client))['rpc']
+
+    def startup(self, clients, sessions, elapsed):
+        """Record the connection phase"""
+        self.emit('startup', clients=clients, sessions=sessions, startupSeconds=round(elapsed, 3))
+
+    def message_sent(self, client, index, message, latency, rpc_count):
+        """Record a sent message"""
+        self.sent += 1
+        self.latencies.append(latency)
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        label = client_label(client)
+        self.client_stats(label)['sent'] += 1
+        self.emit('message', status='sent', index=index, messageId=message.id, kind=message.kind, client=label,
+                  latencyMs=round(latency * 1000), rpcCount=rpc_count)
+
+    def message_failed(self, client, index, message, latency, rpc_count, error):
+        """Record a message that could not be sent"""
+        self.failed += 1
+        label = client_label(client)
+        self.client_error(client, error)
+        self.emit('message', status='failed', index=index, messageId=message.id, kind=message.kind, client=label,
+                  latencyMs=round(latency * 1000), rpcCount=rpc_count, error=str(error))
+
+    def client_error(self, client, error):
+        """Record an error of a client (send, join or listener)"""
+        label = client_label(client)
+        stats = self.client_stats(label)
+        stats['errors'] += 1
+        stats['lastError'] = str(error)
+        seconds = getattr(error, 'seconds', None)
+        if type(error).__name__ == 'FloodWaitError' and seconds is not None:
+            request = getattr(error, 'request', None)
+            self.flood_wait(client, seconds, type(request).__name__ if request else None)
+        self.emit('client_error', client=label, errors=stats['errors'], error=str(error))
+
+    def flood_wait(self, client, seconds, request_name, slept=False):
+        """Record a FloodWait, either raised to us or waited out by the rate controller"""
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        label = client_label(client) if client else None
+        if label:
+            self.client_stats(label)['floodWaits'] += 1
+        self.emit('flood_wait', client=label, seconds=seconds, request=request_name, slept=slept)
+
+    def cycle_complete(self, sent):
+        """Record the end of one pass over the message plan"""
+        self.cycle += 1
+        self.emit('cycle_complete', cycle=self.cycle, sent=sent)
+        self.write_status()
+
+    def summary(self, running=True):
+        """Snapshot of all counters"""
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000) if latencies else None
+
+        return {
+            'running': running,
+            'pid': os.getpid(),
+            'startedAt': datetime.fromtimestamp(self.started_at).isoformat(),
+            'updatedAt': datetime.now().isoformat(),
+            'uptimeSeconds': round(time.time() - self.started_at),
+            'cycle': self.cycle,
+            'sent': self.sent,
+            'failed': self.failed,
+            'latencyMs': {
+                'avg': round(self.latency_total / self.sent * 1000) if self.sent else None,
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'max': round(self.latency_max * 1000)
+            },
+            'rpc': {'total': self.rpc_total, 'byRequest': dict(self.rpc_by_request.most_common())},
+            'floodWaits': {'count': self.flood_waits, 'seconds': self.flood_wait_seconds},
+            'pacing': rate_controller.snapshot(),
+            'clients': self.clients
+        }
+
+    async def run_status_writer(self):
+        """Write a summary every STATUS_INTERVAL seconds, also while waiting between messages"""
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            self.write_status()
+
+    def write_status(self, running=True):
+        """Print a summary event and write it to the status file"""
+        summary = self.summary(running)
+        self.emit('summary', **summary)
+        if not self.status_file:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.status_file), exist_ok=True)
+            tmp_file = self.status_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.status_file)
+        except Exception as e:
+            print(f"Failed to write status file: {str(e)}")
+
+    def remove_status(self):
+        """Delete the status file once the run has finished"""
+        if not self.status_file:
+            return
+        try:
+            os.remove(self.status_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to remove status file: {str(e)}")
@@ -18,6 +18,10 @@ def get_user_sessions_dir(user_email):
     os.makedirs(sessions_dir, exist_ok=True)
     return sessions_dir
 
+# 常驻Python worker只监听本机，Next.js路由通过HTTP调用
+WORKER_HOST = '127.0.0.1'
+WORKER_PORT = 8765
+
 # Emoji list for reactions
 REACTION_EMOJIS = ['👍', '🔥', '🎉', '💯']
 
@@ -0,0 +1,381 @@
+"""
+Offline stand-in for TelegramClient, used by benchmark.py
+
+FakeTelegram holds synthetic groups and the knobs for injected latency and
+FloodWait. backend.client_class() returns a TelegramClient replacement that
+can be assigned to a script's TelegramClient name (or auto_chat's
+metrics.client_class). It only implements the calls these scripts make.
+"""
+import os
+import random
+import asyncio
+import contextlib
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+# Telethon按100条一页拉取历史消息
+HISTORY_PAGE_SIZE = 100
+# Telethon的request_retries默认值，FloodWait自己睡眠后最多重试这么多次
+REQUEST_RETRIES = 5
+# 默认的媒体比例，其余为文本消息
+DEFAULT_MEDIA_MIX = {'photo': 0.15, 'video': 0.02, 'sticker': 0.05, 'file': 0.05}
+# 服务端过滤器返回的消息种类
+SERVER_FILTER_KINDS = {
+    'InputMessagesFilterPhotos': {'photo'},
+    'InputMessagesFilterVideo': {'video'},
+    'InputMessagesFilterPhotoVideo': {'photo', 'video'},
+    'InputMessagesFilterDocument': {'file'}
+}
+
+
+_request_classes = {}
+
+
+def fake_request(name, **fields):
+    """Request object whose type name is the Telegram method it stands for"""
+    if name not in _request_classes:
+        _request_classes[name] = type(name, (SimpleNamespace,), {})
+    return _request_classes[name](**fields)
+
+
+def filter_kinds(message_filter):
+    """Message kinds a Telegram search filter (class or instance) returns, None for no filter"""
+    if message_filter is None:
+        return None
+    name = getattr(message_filter, '__name__', type(message_filter).__name__)
+    return SERVER_FILTER_KINDS.get(name, set())
+
+
+class FakeList(list):
+    """List with the total attribute Telethon's get_messages result carries"""
+    total = 0
+
+
+class FakePhoto(SimpleNamespace):
+    pass
+
+
+class FakeDocument(SimpleNamespace):
+    pass
+
+
+class FakeMessage:
+    """Message with the attributes the scripts read from telethon's Message"""
+
+    def __init__(self, message_id, date, text=None, kind='text', handle=None, reply_to=None):
+        self.id = message_id
+        self.kind = kind
+        self.date = date
+        self.text = text
+        self.message = text
+        self.sender = None
+        self.reply_to = reply_to
+        self.photo = handle if kind == 'photo' else None
+        self.document = handle if kind in ('sticker', 'video', 'file') else None
+        self.sticker = handle if kind == 'sticker' else None
+        self.video = handle if kind == 'video' else None
+        self.voice = None
+        self.audio = None
+        if kind == 'photo':
+            self.media = SimpleNamespace(photo=handle)
+        elif self.document is not None:
+            self.media = SimpleNamespace(document=handle)
+        else:
+            self.media = None
+        self.file = SimpleNamespace(id=str(handle.id), name=getattr(handle, 'file_name', None)) if handle else None
+
+
+class FakeGroup:
+    """Synthetic group history, newest message has the highest id"""
+
+    def __init__(self, name, size, media_mix=None, media_pool=None, media_size=50000, seed=0):
+        self.name = name
+        self.messages = {}
+        self.last_id = 0
+        rng = random.Random(f"{seed}:{name}")
+        media_mix = DEFAULT_MEDIA_MIX if media_mix is None else media_mix
+        # media_pool限制不同媒体文件的数量，模拟多个群组之间重复的表情包和贴纸
+        media_pool = media_pool or size
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for _ in range(size):
+            kind = 'text'
+            roll = rng.random()
+            for media_kind, share in media_mix.items():
+                if roll < share:
+                    kind = media_kind
+                    break
+                roll -= share
+            media_id = rng.randrange(media_pool) + 1
+            self.append(kind, text=f"message {self.last_id + 1}", media_id=media_id, media_size=media_size,
+                        date=start + timedelta(minutes=self.last_id))
+
+    def append(self, kind='text', text=None, media_id=None, media_size=0, date=None, reply_to=None):
+        """Add a message to the end of the history"""
+        self.last_id += 1
+        handle = None
+        if kind == 'photo':
+            handle = FakePhoto(id=media_id, size=media_size)
+        elif kind in ('sticker', 'video', 'file'):
+            handle = FakeDocument(
+                id=media_id,
+                access_hash=media_id * 7,
+                file_reference=media_id.to_bytes(8, 'big'),
+                attributes=[],
+                size=media_size,
+                mime_type={'sticker': 'image/webp', 'video': 'video/mp4'}.get(kind, 'application/octet-stream'),
+                file_name=None if kind == 'sticker' else f"file_{media_id}.bin"
+            )
+        message = FakeMessage(self.last_id, date or datetime.now(timezone.utc), text, kind, handle, reply_to)
+        self.messages[self.last_id] = message
+        return message
+
+
+class FakeTelegram:
+    """Shared state of the fake backend: groups, injected latency and FloodWait, and call counters"""
+
+    def __init__(self, latency=0.0, jitter=0.0, connect_latency=0.0, flood_wait_rate=0.0, flood_wait_seconds=1,
+                 rate_limit=None, bandwidth=None, unauthorized=(), refuse_takeout=False, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.connect_latency = connect_latency
+        self.flood_wait_rate = flood_wait_rate
+        self.flood_wait_seconds = flood_wait_seconds
+        # 每个session每种请求每秒最多几次，超过时返回FloodWait（像Telegram一样可以被学习到）
+        self.rate_limit = rate_limit
+        self.recent_calls = {}
+        # 下载和上传的带宽（字节/秒），None表示不限速
+        self.bandwidth = bandwidth
+        self.unauthorized = set(unauthorized)
+        # 模拟Telegram要求先在应用里确认导出请求
+        self.refuse_takeout = refuse_takeout
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.groups = {}
+        self.calls = Counter()
+        self.flood_waits = 0
+        # 被客户端自己睡眠消化、没有抛给调用方的FloodWait
+        self.flood_waits_slept = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.sent = 0
+        # NewMessage事件的订阅 (client, callback, event)
+        self.handlers = []
+
+    def add_group(self, name, size, **options):
+        """Create a synthetic group with size messages"""
+        self.groups[name] = FakeGroup(name, size, seed=self.seed, **options)
+        return self.groups[name]
+
+    def group(self, entity):
+        """Look up a group by name, peer or @username"""
+        name = getattr(entity, 'name', entity)
+        name = str(name).lstrip('@').rsplit('/', 1)[-1]
+        if name not in self.groups:
+            raise ValueError(f'Cannot find any entity corresponding to "{name}"')
+        return self.groups[name]
+
+    def post(self, entity, kind='text', **options):
+        """Add a message to a group and deliver it to the NewMessage handlers of connected clients"""
+        group = self.group(entity)
+        message = group.append(kind, **options)
+        for client, callback, event in list(self.handlers):
+            chats = getattr(event, 'chats', None)
+            if client.connected and (chats is None or self.group(chats) is group):
+                asyncio.ensure_future(callback(SimpleNamespace(message=message, chat_id=group.name)))
+        return message
+
+    async def rpc(self, name, transfer_bytes=0, session=None):
+        """Count one call and apply the injected latency and FloodWait"""
+        self.calls[name] += 1
+        if self.rate_limit:
+            now = asyncio.get_running_loop().time()
+            recent = self.recent_calls.setdefault((session, name), deque())
+            while recent and recent[0] <= now - 1:
+                recent.popleft()
+            if len(recent) >= self.rate_limit:
+                from telethon.errors import FloodWaitError
+                self.flood_waits += 1
+                raise FloodWaitError(request=None, capture=self.flood_wait_seconds)
+            recent.append(now)
+        delay = self.latency + (self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if self.bandwidth and transfer_bytes:
+            delay += transfer_bytes / self.bandwidth
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.flood_wait_rate and self.rng.random() < self.flood_wait_rate:
+            from telethon.errors import FloodWaitError
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_wait_seconds)
+
+    def stats(self):
+        """Counters collected so far"""
+        return {
+            'rpc': sum(self.calls.values()),
+            'calls': dict(self.calls.most_common()),
+            'floodWaits': self.flood_waits,
+            'floodWaitsSlept': self.flood_waits_slept,
+            'sent': self.sent,
+            'bytesDownloaded': self.bytes_downloaded,
+            'bytesUploaded': self.bytes_uploaded
+        }
+
+    def client_class(self):
+        """TelegramClient replacement bound to this backend"""
+        backend = self
+
+        class FakeTelegramClient:
+            def __init__(self, session, api_id=None, api_hash=None, **kwargs):
+                session = str(session)
+                if not session.endswith('.session'):
+                    session += '.session'
+                self.session = SimpleNamespace(filename=session, takeout_id=None)
+                self.backend = backend
+                self.connected = False
+                self.handlers = []
+                self.flood_sleep_threshold = 60
+
+            async def connect(self):
+                if backend.connect_latency:
+                    await asyncio.sleep(backend.connect_latency)
+                self.connected = True
+
+            def is_connected(self):
+                return self.connected
+
+            async def disconnect(self):
+                self.connected = False
+
+            async def is_user_authorized(self):
+                await self._call(None, fake_request('GetStateRequest'))
+                return os.path.basename(self.session.filename) not in backend.unauthorized
+
+            async def get_me(self):
+                await self._call(None, fake_request('GetUsersRequest'))
+                phone = os.path.basename(self.session.filename).replace('.session', '')
+                return SimpleNamespace(id=abs(hash(phone)) % 10 ** 9, first_name=phone, last_name=None,
+                                       username=f"user_{phone}", phone=phone, bot=False)
+
+            async def get_input_entity(self, peer):
+                await self._call(None, fake_request('ResolveUsernameRequest'))
+                return SimpleNamespace(name=backend.group(peer).name)
+
+            async def get_messages(self, entity, limit=None, ids=None, **kwargs):
+                group = backend.group(entity)
+                if ids is not None:
+                    await self._call(None, fake_request('GetMessagesRequest'))
+                    if isinstance(ids, int):
+                        return group.messages.get(ids)
+                    return [group.messages.get(message_id) for message_id in ids]
+                result = FakeList()
+                if limit != 0:
+                    async for message in self.iter_messages(entity, limit=limit, **kwargs):
+                        result.append(message)
+                else:
+                    await self._call(None, fake_request('GetHistoryRequest'))
+                kinds = filter_kinds(kwargs.get('filter'))
+                result.total = sum(1 for m in group.messages.values() if kinds is None or m.kind in kinds)
+                return result
+
+            async def iter_messages(self, entity, limit=None, min_id=0, offset_id=0, reply_to=None, offset_date=None,
+                                    filter=None, **kwargs):
+                group = backend.group(entity)
+                kinds = filter_kinds(filter)
+                request_name = 'SearchRequest' if kinds is not None else 'GetHistoryRequest'
+                message_id = (offset_id - 1) if offset_id else group.last_id
+                count = 0
+                await self._call(None, fake_request(request_name))
+                page_left = HISTORY_PAGE_SIZE
+                while message_id > min_id and (limit is None or count < limit):
+                    message = group.messages.get(message_id)
+                    message_id -= 1
+                    if message is None or (reply_to and message.reply_to != reply_to):
+                        continue
+                    if (offset_date and message.date >= offset_date) or (kinds is not None and message.kind not in kinds):
+                        continue
+                    # 服务端过滤后按页返回，只有匹配的消息占用页的位置
+                    if page_left == 0:
+                        await self._call(None, fake_request(request_name))
+                        page_left = HISTORY_PAGE_SIZE
+                    page_left -= 1
+                    count += 1
+                    yield message
+
+            async def download_media(self, media, file=None, **kwargs):
+                size = getattr(media, 'size', 0)
+                await self._call(None, fake_request('GetFileRequest', size=size))
+                backend.bytes_downloaded += size
+                # 内容只由媒体ID决定，同一个文件在不同群组里内容相同
+                with open(file, 'wb') as f:
+                    f.write(f"{type(media).__name__}:{media.id}:".encode().ljust(size, b'\0'))
+                return file
+
+            async def send_message(self, entity, message='', file=None, reply_to=None, **kwargs):
+                await self._call(None, fake_request('SendMessageRequest'))
+                backend.sent += 1
+                kind = 'sticker' if file is not None else 'text'
+                return backend.post(entity, kind, text=message, media_id=1, reply_to=reply_to)
+
+            async def send_file(self, entity, file, reply_to=None, force_document=False, **kwargs):
+                size = 0
+                if isinstance(file, str):
+                    size = os.path.getsize(file)
+                    backend.bytes_uploaded += size
+                    await self._call(None, fake_request('SaveFilePartRequest', size=size))
+                    kind = 'file' if force_document else 'photo'
+                    media_id = abs(hash(file)) % 10 ** 9
+                else:
+                    # 复用之前上传返回的Photo/Document
+                    kind = 'photo' if isinstance(file, FakePhoto) else 'file'
+                    media_id = file.id
+                await self._call(None, fake_request('SendMediaRequest'))
+                backend.sent += 1
+                return backend.post(entity, kind, media_id=media_id, media_size=size, reply_to=reply_to)
+
+            async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+                await self._call(None, request, ordered, flood_sleep_threshold)
+                if type(request).__name__ == 'GetStickerSetRequest':
+                    return SimpleNamespace(documents=[])
+                return None
+
+            async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+                # 所有请求都经过这里，和Telethon一样，可以被子类（例如限速器）包装
+                # 和Telethon 1.34一样只看实例的flood_sleep_threshold（忽略参数）：不超过它的FloodWait自己睡眠后重试
+                from telethon.errors import FloodWaitError
+                for attempt in range(REQUEST_RETRIES):
+                    try:
+                        return await backend.rpc(type(request).__name__, getattr(request, 'size', 0), self.session.filename)
+                    except FloodWaitError as e:
+                        if e.seconds > self.flood_sleep_threshold or attempt == REQUEST_RETRIES - 1:
+                            raise
+                        backend.flood_waits_slept += 1
+                        await asyncio.sleep(e.seconds)
+
+            @contextlib.asynccontextmanager
+            async def takeout(self, finalize=True, **kwargs):
+                # 和Telethon一样，takeout客户端发出的请求另外计数
+                await self._call(None, fake_request('InitTakeoutSessionRequest'))
+                if backend.refuse_takeout:
+                    from telethon.errors import TakeoutInitDelayError
+                    raise TakeoutInitDelayError(request=None, capture=86400)
+                self.session.takeout_id = 1
+                try:
+                    yield self
+                finally:
+                    await self._call(None, fake_request('FinishTakeoutSessionRequest'))
+                    self.session.takeout_id = None
+
+            async def end_takeout(self, success):
+                self.session.takeout_id = None
+                return True
+
+            def add_event_handler(self, callback, event=None):
+                self.handlers.append(callback)
+                backend.handlers.append((self, callback, event))
+
+            def remove_event_handler(self, callback, event=None):
+                if callback in self.handlers:
+                    self.handlers.remove(callback)
+                backend.handlers = [entry for entry in backend.handlers if entry[:2] != (self, callback)]
+
+        return FakeTelegramClient
@@ -1,18 +1,49 @@
-import os
 import sys
+import startup_profile
+startup_profile.enable_if_requested()
+
+import os
 import json
 import asyncio
 import argparse
-from telethon import TelegramClient
+from rate_control import TelegramClient
 from config import (
     API_ID,
     API_HASH,
     PROXY_CONFIGS,
     BASE_SESSIONS_DIR
 )
+from session_cache import SessionCache, DEFAULT_CACHE_TTL
+
+def print_cached_info(session_path, entry):
+    """Print and return session information from a cached session record"""
+    phone = os.path.basename(session_path).replace('.session', '')
+    if entry['status'] != 'valid':
+        print(json.dumps({
+            "type": "error",
+            "message": "Session is not authorized",
+            "phone": phone
+        }))
+        return None
+    
+    info = {
+        "type": "success",
+        "phone": phone,
+        "first_name": entry.get('first_name'),
+        "last_name": entry.get('last_name'),
+        "username": entry.get('username'),
+        "id": entry.get('user_id')
+    }
+    print(json.dumps(info))
+    return info
 
-async def get_session_info(session_path):
-    """Get user information from a session file"""
+async def get_session_info(session_path, cache=None, client=None):
+    """Get user information from a session file, optionally with an already connected client"""
+    entry = cache.get(session_path) if cache else None
+    if entry:
+        return print_cached_info(session_path, entry)
+    
+    record = None
     try:
         session_name = os.path.basename(session_path)
         phone = session_name.replace('.session', '')
@@ -20,17 +51,22 @@ async def get_session_info(session_path):
         # 使用第一个代理配置
         proxy_config = PROXY_CONFIGS[0]
         
-        client = TelegramClient(
-            session_path.replace('.session', ''),
-            API_ID,
-            API_HASH,
-            proxy=proxy_config
-        )
+        # 常驻worker传入的客户端已经连接，由连接池负责断开
+        owns_client = client is None
+        if owns_client:
+            client = TelegramClient(
+                session_path.replace('.session', ''),
+                API_ID,
+                API_HASH,
+                proxy=proxy_config
+            )
         
         try:
-            await client.connect()
+            if owns_client:
+                await client.connect()
             
             if not await client.is_user_authorized():
+                record = {'status': 'invalid', 'error': 'Not authorized'}
                 print(json.dumps({
                     "type": "error",
                     "message": "Session is not authorized",
@@ -40,6 +76,13 @@ async def get_session_info(session_path):
             
             # 获取用户信息
             me = await client.get_me()
+            record = {
+                'status': 'valid',
+                'username': me.username,
+                'first_name': me.first_name,
+                'last_name': me.last_name,
+                'user_id': me.id
+            }
             
             info = {
                 "type": "success",
@@ -62,7 +105,11 @@ async def get_session_info(session_path):
             return None
             
         finally:
-            await client.disconnect()
+            if owns_client:
+                await client.disconnect()
+            # 断开后再写缓存，此时session文件的mtime已经确定
+            if cache and record:
+                cache.put(session_path, record)
             
     except Exception as e:
         print(json.dumps({
@@ -71,7 +118,7 @@ async def get_session_info(session_path):
         }))
         return None
 
-async def get_all_sessions_info(user_email):
+async def get_all_sessions_info(user_email, cache_ttl=DEFAULT_CACHE_TTL):
     """Get information for all sessions of a user"""
     sessions_dir = os.path.join(BASE_SESSIONS_DIR, user_email)
     
@@ -91,22 +138,28 @@ async def get_all_sessions_info(user_email):
         }))
         return []
     
+    cache = SessionCache(sessions_dir, cache_ttl)
     results = []
-    for session_file in session_files:
-        session_path = os.path.join(sessions_dir, session_file)
-        info = await get_session_info(session_path)
-        if info:
-            results.append(info)
+    try:
+        for session_file in session_files:
+            session_path = os.path.join(sessions_dir, session_file)
+            info = await get_session_info(session_path, cache)
+            if info:
+                results.append(info)
+    finally:
+        cache.save()
     
     return results
 
 async def main():
-    parser = argparse.ArgumentParser(description='Get Telegram session information')
+    parser = argparse.ArgumentParser(description='Get Telegram session information', allow_abbrev=False)
     parser.add_argument('--user-email', required=True, help='User email')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, help='Reuse results younger than this many seconds (0 disables the cache)')
+    parser.add_argument('--startup-profile', action='store_true', help='Print import time per module to stderr at exit')
     args = parser.parse_args()
     
     try:
-        await get_all_sessions_info(args.user_email)
+        await get_all_sessions_info(args.user_email, args.cache_ttl)
     except Exception as e:
         print(json.dumps({
             "type": "error",
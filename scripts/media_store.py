@@ -0,0 +1,236 @@
+"""
+Content-addressed store for downloaded media, shared by all groups and rescrapes
+
+Files are stored once under objects/<sha256[:2]>/<sha256><ext> and indexed by
+their Telegram photo/document id under by_id/. Each group's media/ folder gets
+a hardlink to the stored file (a copy where hardlinks are not supported), so
+the message source folders stay self-contained. Every group file linked from
+the store is recorded in refs.log, which prune uses to find unused files.
+"""
+import os
+import uuid
+import shutil
+import asyncio
+import hashlib
+
+# 仓库目录名，放在scraped_data下，不在任何用户目录里
+MEDIA_STORE_NAME = '.media_store'
+HASH_CHUNK_SIZE = 1024 * 1024
+# 记录每个ID链接到了哪些群组文件，一行一个 "<by_id文件名>\t<群组文件路径>"，只追加
+REFS_NAME = 'refs.log'
+
+_stores = {}
+
+
+def get_media_store(data_dir):
+    """Get the shared media store of a data directory (one instance per process)"""
+    root = os.path.join(data_dir, MEDIA_STORE_NAME)
+    if root not in _stores:
+        _stores[root] = MediaStore(root)
+    return _stores[root]
+
+
+def file_sha256(file_path):
+    """Hash a file in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def expected_size(handle):
+    """Size in bytes Telegram reports for a photo (its largest size) or document, None if unknown"""
+    if getattr(handle, 'size', None) is not None:
+        return handle.size
+    sizes = []
+    for photo_size in getattr(handle, 'sizes', None) or []:
+        if getattr(photo_size, 'size', None) is not None:
+            sizes.append(photo_size.size)
+        elif getattr(photo_size, 'sizes', None):
+            # 渐进式JPEG的最后一个尺寸是完整文件
+            sizes.append(max(photo_size.sizes))
+    return max(sizes) if sizes else None
+
+
+def link_file(source, target):
+    """Hardlink source to target (copy if hardlinks are not possible), replacing target atomically"""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    tmp_file = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(source, tmp_file)
+    except OSError:
+        # 跨盘或文件系统不支持硬链接时复制
+        shutil.copy2(source, tmp_file)
+    os.replace(tmp_file, target)
+
+
+class MediaStore:
+    """Downloaded media keyed by Telegram id, deduplicated by content hash"""
+
+    def __init__(self, root):
+        self.root = root
+        self.locks = {}
+        # 本进程已经记录过的引用，重复抓取时不再追加
+        self.recorded = set()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'by_id'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+
+    def id_path(self, kind, media_id, extension):
+        """Index path of a Telegram photo/document id"""
+        # 照片和文档的ID是两个不同的空间，所以带上类型
+        return os.path.join(self.root, 'by_id', f"{kind}_{media_id}{extension}")
+
+    def object_path(self, digest, extension):
+        """Content-addressed path of a file"""
+        return os.path.join(self.root, 'objects', digest[:2], f"{digest}{extension}")
+
+    def add(self, kind, media_id, extension, file_path, move=True):
+        """Put a file into the store and index it by id; returns the stored path"""
+        digest = file_sha256(file_path)
+        stored = self.object_path(digest, extension)
+        if os.path.exists(stored):
+            # 内容相同的文件已经存在（不同ID的同一个文件）
+            if move:
+                os.remove(file_path)
+        else:
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            if move:
+                os.replace(file_path, stored)
+            else:
+                link_file(file_path, stored)
+        link_file(stored, self.id_path(kind, media_id, extension))
+        return stored
+
+    async def fetch(self, client, kind, handle, target):
+        """Link a photo/document into target, downloading it only if it is not stored yet
+
+        Returns True if the file had to be downloaded.
+        """
+        extension = os.path.splitext(target)[1]
+        id_path = self.id_path(kind, handle.id, extension)
+        # 同一个文件被多个worker或多个群组同时请求时只下载一次
+        lock = self.locks.setdefault(id_path, asyncio.Lock())
+        async with lock:
+            downloaded = False
+            if not os.path.exists(id_path):
+                if os.path.exists(target) and os.path.getsize(target) == expected_size(handle):
+                    # 以前下载到群组目录的完整文件直接收进仓库；大小不对的可能是中断的下载，重新下载
+                    await asyncio.to_thread(self.add, kind, handle.id, extension, target, False)
+                else:
+                    tmp_file = os.path.join(self.root, 'tmp', f"{uuid.uuid4().hex}{extension}")
+                    try:
+                        tmp_file = await client.download_media(handle, tmp_file) or tmp_file
+                        if not os.path.exists(tmp_file):
+                            raise Exception(f"Download of {kind} {handle.id} produced no file")
+                        await asyncio.to_thread(self.add, kind, handle.id, extension, tmp_file)
+                        downloaded = True
+                    finally:
+                        if os.path.exists(tmp_file):
+                            os.remove(tmp_file)
+            link_file(id_path, target)
+            self.record_ref(id_path, target)
+        return downloaded
+
+    def record_ref(self, id_path, target):
+        """Record that a group file was linked from a stored id"""
+        key = (id_path, os.path.abspath(target))
+        if key in self.recorded:
+            return
+        self.recorded.add(key)
+        with open(os.path.join(self.root, REFS_NAME), 'a', encoding='utf-8') as f:
+            f.write(f"{os.path.basename(id_path)}\t{os.path.abspath(target)}\n")
+
+    def read_refs(self):
+        """Read the recorded references as {by_id name: set of group files}, and the bytes read"""
+        refs = {}
+        try:
+            with open(os.path.join(self.root, REFS_NAME), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return refs, 0
+        # 只处理完整的行，其他进程可能正在追加
+        complete = data[:data.rfind(b'\n') + 1]
+        for line in complete.decode('utf-8').splitlines():
+            name, _, target = line.partition('\t')
+            if target:
+                refs.setdefault(name, set()).add(target)
+        return refs, len(complete)
+
+    def write_refs(self, refs, read_bytes):
+        """Rewrite the reference log with the given references, keeping lines appended since it was read"""
+        refs_file = os.path.join(self.root, REFS_NAME)
+        tmp_file = f"{refs_file}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8', newline='') as f:
+            for name in sorted(refs):
+                for target in sorted(refs[name]):
+                    f.write(f"{name}\t{target}\n")
+        try:
+            with open(refs_file, 'rb') as f:
+                f.seek(read_bytes)
+                appended = f.read()
+        except FileNotFoundError:
+            appended = b''
+        with open(tmp_file, 'ab') as f:
+            f.write(appended)
+        os.replace(tmp_file, refs_file)
+
+    def prune(self):
+        """Remove stored files no group folder uses any more; returns (files, bytes) removed
+
+        A stored id is in use while one of the group files recorded for it
+        still exists. Ids without any recorded group file (stored before
+        references were recorded) are kept.
+        """
+        refs, read_bytes = self.read_refs()
+        live_refs = {}
+        for name, targets in refs.items():
+            live = {target for target in targets if os.path.exists(target)}
+            if live:
+                live_refs[name] = live
+
+        # 按内容（而不是硬链接数）找到每个ID对应的仓库文件，复制代替硬链接时也一样
+        by_id = os.path.join(self.root, 'by_id')
+        objects = {}
+        inodes = {}
+        for folder, _, files in os.walk(os.path.join(self.root, 'objects')):
+            for name in files:
+                objects[name] = os.path.join(folder, name)
+                stat = os.stat(objects[name])
+                inodes[(stat.st_dev, stat.st_ino)] = name
+        object_ids = {name: [] for name in objects}
+        for name in os.listdir(by_id):
+            id_path = os.path.join(by_id, name)
+            stat = os.stat(id_path)
+            stored = inodes.get((stat.st_dev, stat.st_ino))
+            if stored is None:
+                # 不是硬链接（复制的）时按内容哈希找
+                stored = f"{file_sha256(id_path)}{os.path.splitext(name)[1]}"
+            object_ids.setdefault(stored, []).append(name)
+
+        removed, freed = 0, 0
+        for object_name, names in object_ids.items():
+            if any(name in live_refs or name not in refs for name in names):
+                continue
+            for name in names:
+                os.remove(os.path.join(by_id, name))
+            if object_name in objects:
+                freed += os.path.getsize(objects[object_name])
+                os.remove(objects[object_name])
+            removed += 1
+        self.write_refs(live_refs, read_bytes)
+        return removed, freed
+
+if __name__ == '__main__':
+    import argparse
+    from scrape_messages import DATA_DIR
+
+    parser = argparse.ArgumentParser(description='Maintain the shared media store')
+    parser.add_argument('--prune', action='store_true', help='Remove stored files that no group folder uses any more')
+    args = parser.parse_args()
+
+    if args.prune:
+        removed, freed = get_media_store(DATA_DIR).prune()
+        print(f"Removed {removed} unused files ({freed / (1024 * 1024):.1f} MB)")
@@ -0,0 +1,134 @@
+"""
+Message source files shared by the scraper (writer) and auto chat (reader)
+
+A message source is always stored as <name>_messages.csv. When pyarrow is
+installed a typed <name>_messages.parquet copy can be written next to it,
+which loads much faster and skips the date/type parsing on every start.
+"""
+import os
+import csv
+import json
+
+# 消息源CSV的列
+CSV_FIELDS = ['id', 'date', 'type', 'content', 'media_file']
+
+# 自动聊天编译发送计划时用到的列，读Parquet时只读这些列
+PLAN_FIELDS = ['id', 'type', 'content', 'media_file']
+
+# 贴纸（和文档）的Telegram引用统一保存在media目录下的一个索引文件里，按消息ID索引
+STICKER_INDEX_NAME = 'stickers.json'
+
+
+def get_source_paths(source_dir, source_name):
+    """Get the CSV and Parquet paths of a message source"""
+    base = os.path.join(source_dir, f"{source_name}_messages")
+    return base + '.csv', base + '.parquet'
+
+
+def parquet_available():
+    """Check whether pyarrow is installed, without failing if it is not"""
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def write_parquet(csv_file, parquet_file=None):
+    """Convert a message source CSV to a typed Parquet file"""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+
+    if parquet_file is None:
+        parquet_file = os.path.splitext(csv_file)[0] + '.parquet'
+
+    convert_options = pacsv.ConvertOptions(
+        column_types={
+            'id': pa.int64(),
+            'date': pa.timestamp('us', tz='UTC'),
+            'type': pa.dictionary(pa.int32(), pa.string()),
+            'content': pa.string(),
+            'media_file': pa.string()
+        },
+        # 与pandas.read_csv一致，空字段读作缺失值
+        strings_can_be_null=True
+    )
+
+    # 按批流式转换，写入临时文件后原子替换
+    tmp_file = parquet_file + '.tmp'
+    reader = pacsv.open_csv(csv_file, convert_options=convert_options)
+    with pq.ParquetWriter(tmp_file, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+    os.replace(tmp_file, parquet_file)
+    return parquet_file
+
+
+def read_parquet_rows(parquet_file, columns=PLAN_FIELDS):
+    """Read the given columns of a Parquet message source as row dicts, converting column by column"""
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(parquet_file, columns=columns)
+    values = []
+    for name in columns:
+        column = table.column(name)
+        # 字典编码的列逐个值转换很慢，先解码成普通字符串列
+        if hasattr(column.type, 'value_type'):
+            column = column.cast(column.type.value_type)
+        values.append(column.to_pylist())
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def load_message_source(source_dir, source_name):
+    """Load a message source as a list of row dicts, preferring the Parquet copy (PLAN_FIELDS only)"""
+    csv_file, parquet_file = get_source_paths(source_dir, source_name)
+    # 只在Parquet不比CSV旧时使用（上传的CSV会覆盖旧的抓取结果）
+    if os.path.exists(parquet_file) and parquet_available():
+        if not os.path.exists(csv_file) or os.path.getmtime(parquet_file) >= os.path.getmtime(csv_file):
+            try:
+                return read_parquet_rows(parquet_file), parquet_file
+            except Exception as e:
+                print(f"Failed to read Parquet message source, falling back to CSV: {str(e)}")
+
+    # 普通CSV直接用csv模块读取，不需要加载pandas（utf-8-sig兼容Excel保存的BOM）
+    with open(csv_file, 'r', encoding='utf-8-sig', newline='') as f:
+        return list(csv.DictReader(f)), csv_file
+
+
+def document_reference(document, kind):
+    """Build a JSON-serialisable reference to a Telegram document"""
+    reference = {
+        'type': kind,
+        'id': document.id,
+        'access_hash': document.access_hash,
+        'file_reference': document.file_reference.hex()
+    }
+    # 记录贴纸所属的贴纸包，file_reference过期后可以按贴纸包批量刷新
+    for attribute in getattr(document, 'attributes', None) or []:
+        stickerset = getattr(attribute, 'stickerset', None)
+        if getattr(stickerset, 'access_hash', None) is not None:
+            reference['stickerset'] = {'id': stickerset.id, 'access_hash': stickerset.access_hash}
+            break
+    return reference
+
+
+def load_sticker_index(media_dir):
+    """Load the sticker index of a message source, keyed by message id"""
+    index_file = os.path.join(media_dir, STICKER_INDEX_NAME)
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def update_sticker_index(media_dir, entries):
+    """Merge entries into the sticker index and write it back atomically"""
+    index = load_sticker_index(media_dir)
+    index.update({str(message_id): entry for message_id, entry in entries.items()})
+    index_file = os.path.join(media_dir, STICKER_INDEX_NAME)
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_file, index_file)
+    return index
@@ -0,0 +1,281 @@
+"""
+Shared pacing of Telegram requests, learned from FloodWait and latency
+
+Every request of a paced client goes through RateController.call. Requests
+are spaced per session and method. A FloodWait blocks that method of the
+session for the requested time and widens its spacing, which narrows again
+while requests succeed. The learned spacing and running blocks are saved next
+to the session files, so the next run of any script starts from them.
+
+Scripts import the paced client with `from rate_control import TelegramClient`.
+"""
+import os
+import json
+import math
+import time
+import asyncio
+from dataclasses import dataclass
+
+# 保存在session文件所在目录
+RATE_STATE_NAME = '.rate_state.json'
+# 遇到FloodWait后请求间隔至少为多少秒，之后每次FloodWait翻倍
+MIN_BACKOFF_INTERVAL = 0.1
+# 遇到FloodWait时的间隔至少是当时实际请求间隔的多少倍
+FLOOD_BACKOFF = 1.5
+MAX_INTERVAL = 30
+# 每次成功后间隔缩小的比例，逐步试探更高的速率
+INTERVAL_DECAY = 0.98
+# 间隔小于此值时不再限速
+MIN_INTERVAL = 0.01
+# 超过此秒数的请求间隔是空闲，不是请求速率，不计入间隔估计
+IDLE_GAP = 2.0
+# 延迟的指数平滑系数
+LATENCY_SMOOTHING = 0.2
+# 同一个请求因FloodWait自动等待重试的最大次数
+MAX_FLOOD_RETRIES = 3
+
+
+@dataclass(slots=True)
+class PaceState:
+    """Learned pacing of one method of one session"""
+    interval: float = 0.0
+    next_at: float = 0.0
+    blocked_until: float = 0.0
+    backoff_at: float = 0.0
+    last_call: float = 0.0
+    gap: float = None
+    calls: int = 0
+    flood_waits: int = 0
+    flood_wait_seconds: int = 0
+    latency: float = None
+
+
+def session_path_of(client):
+    """Session file of a client, None for in-memory sessions"""
+    return getattr(getattr(client, 'session', None), 'filename', None)
+
+
+def request_name(request):
+    """Method name of a request (the first one of a batch)"""
+    if isinstance(request, (list, tuple)):
+        request = request[0] if request else None
+    if type(request).__name__ == 'InvokeWithTakeoutRequest':
+        # takeout会话里的请求限制不同，单独学习
+        return f"{request_name(request.query)}@takeout"
+    return type(request).__name__
+
+
+def state_file_of(session_path):
+    """Pacing state file shared by the sessions of one directory"""
+    return os.path.join(os.path.dirname(os.path.abspath(session_path)), RATE_STATE_NAME)
+
+
+def read_state_file(state_file):
+    """Read a pacing state file, empty if it is missing or broken"""
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+class RateController:
+    """Per-session, per-method request pacing shared by all clients of a process"""
+
+    def __init__(self):
+        self.sessions = {}
+        # FloodWait回调 (client, seconds, method, slept)，供指标统计
+        self.listeners = []
+
+    def states(self, session_path):
+        """Pacing states of a session keyed by method, loaded from disk on first use"""
+        if session_path not in self.sessions:
+            self.sessions[session_path] = self.load(session_path) if session_path else {}
+        return self.sessions[session_path]
+
+    def state(self, session_path, method):
+        """Pacing state of one method of a session"""
+        states = self.states(session_path)
+        if method not in states:
+            states[method] = PaceState()
+        return states[method]
+
+    def load(self, session_path):
+        """Read the saved pacing of a session"""
+        saved = read_state_file(state_file_of(session_path)).get(os.path.basename(session_path), {})
+        return {
+            method: PaceState(interval=entry.get('interval', 0.0), blocked_until=entry.get('blocked_until', 0.0))
+            for method, entry in saved.items()
+        }
+
+    def save(self, session_path):
+        """Write the learned pacing of a session next to its session file"""
+        if not session_path or session_path not in self.sessions:
+            return
+        now = time.time()
+        entries = {
+            method: {'interval': round(state.interval, 3), 'blocked_until': state.blocked_until}
+            for method, state in self.sessions[session_path].items()
+            if state.interval >= MIN_INTERVAL or state.blocked_until > now
+        }
+        state_file = state_file_of(session_path)
+        try:
+            # 其他进程可能也在写同一个目录的其他session，先合并再写回
+            saved = read_state_file(state_file)
+            if entries:
+                saved[os.path.basename(session_path)] = entries
+            elif saved.pop(os.path.basename(session_path), None) is None:
+                return
+            tmp_file = f"{state_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(saved, f, indent=2)
+            os.replace(tmp_file, state_file)
+        except OSError as e:
+            print(f"Failed to save rate state: {str(e)}")
+
+    def save_all(self):
+        """Save the pacing of every session used in this process"""
+        for session_path in list(self.sessions):
+            self.save(session_path)
+
+    async def wait_turn(self, state, max_sleep, request):
+        """Wait until the next request of a method may be sent"""
+        now = time.time()
+        blocked = state.blocked_until - now
+        if blocked > max_sleep:
+            # 仍在长时间的FloodWait里，不再请求Telegram（会延长惩罚），直接交给调用方
+            from telethon.errors import FloodWaitError
+            raise FloodWaitError(request=request, capture=math.ceil(blocked))
+        # 在本协程睡眠前预留时间槽，并发的请求依次排队
+        slot = max(now, state.next_at, state.blocked_until)
+        state.next_at = slot + state.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        # 实际的请求间隔，FloodWait时据此估计Telegram允许的速率
+        gap = slot - state.last_call
+        if state.last_call and gap <= IDLE_GAP:
+            state.gap = gap if state.gap is None else state.gap + LATENCY_SMOOTHING * (gap - state.gap)
+        state.last_call = slot
+        return slot
+
+    async def call(self, client, request, send, max_sleep):
+        """Send a request through the pacing of its session and method
+
+        FloodWaits up to max_sleep seconds are waited out and retried, longer
+        ones are raised.
+        """
+        from telethon.errors import FloodWaitError
+
+        method = request_name(request)
+        state = self.state(session_path_of(client), method)
+        for attempt in range(MAX_FLOOD_RETRIES + 1):
+            sent_at = await self.wait_turn(state, max_sleep, request)
+            state.calls += 1
+            started = time.monotonic()
+            try:
+                result = await send()
+            except FloodWaitError as e:
+                retry = e.seconds <= max_sleep and attempt < MAX_FLOOD_RETRIES
+                self.flood_wait(client, state, method, e.seconds, retry, sent_at)
+                if not retry:
+                    raise
+                continue
+            self.success(state, time.monotonic() - started)
+            return result
+
+    def flood_wait(self, client, state, method, seconds, slept, sent_at=0.0):
+        """Block a method for the FloodWait and widen its spacing"""
+        now = time.time()
+        state.flood_waits += 1
+        state.flood_wait_seconds += seconds
+        state.blocked_until = max(state.blocked_until, now + seconds)
+        # 上次放慢之前就已发出的请求碰到的FloodWait不再重复放慢
+        if sent_at >= state.backoff_at:
+            state.interval = min(MAX_INTERVAL, max(
+                MIN_BACKOFF_INTERVAL, state.interval * 2, (state.gap or 0) * FLOOD_BACKOFF
+            ))
+            state.backoff_at = now
+        for listener in self.listeners:
+            listener(client, seconds, method, slept)
+
+    async def wait_out(self, client, error):
+        """Sleep out a FloodWait that was raised to the caller, through the pacing of its session and method"""
+        method = request_name(getattr(error, 'request', None))
+        state = self.state(session_path_of(client), method)
+        if state.blocked_until < time.time() + error.seconds - 1:
+            # 不是限速器抛出的（它抛出前已经记录过），在这里记录
+            self.flood_wait(client, state, method, error.seconds, True)
+        # 立即保存，其他进程使用同一个session时也等待
+        self.save(session_path_of(client))
+        await asyncio.sleep(max(0.0, state.blocked_until - time.time()))
+
+    def success(self, state, latency):
+        """Record a successful request and narrow the spacing a little"""
+        state.latency = latency if state.latency is None else (
+            state.latency + LATENCY_SMOOTHING * (latency - state.latency)
+        )
+        state.interval *= INTERVAL_DECAY
+        if state.interval < MIN_INTERVAL:
+            state.interval = 0.0
+
+    def snapshot(self, client=None):
+        """Pacing metrics of all sessions (or one client's session), keyed by session file and method"""
+        now = time.time()
+        sessions = self.sessions if client is None else {
+            session_path_of(client): self.sessions.get(session_path_of(client), {})
+        }
+        return {
+            os.path.basename(session_path or 'memory'): {
+                method: {
+                    'calls': state.calls,
+                    'floodWaits': state.flood_waits,
+                    'floodWaitSeconds': state.flood_wait_seconds,
+                    'intervalMs': round(state.interval * 1000),
+                    'blockedSeconds': max(0, math.ceil(state.blocked_until - now)),
+                    'latencyMs': round(state.latency * 1000) if state.latency is not None else None
+                }
+                for method, state in states.items()
+            }
+            for session_path, states in sessions.items()
+        }
+
+
+rate_controller = RateController()
+_client_classes = {}
+
+
+def paced_client_class(base=None):
+    """TelegramClient subclass whose requests all go through the shared rate controller"""
+    if base is None:
+        from telethon import TelegramClient as base
+    if base not in _client_classes:
+        class PacedTelegramClient(base):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                # Telethon的_call只按实例的flood_sleep_threshold决定是否自己睡眠（忽略参数），
+                # 设为0让所有FloodWait都抛给限速器，调用方设置的阈值作为限速器的最长等待
+                self.pacing_max_sleep = self.flood_sleep_threshold
+                self.flood_sleep_threshold = 0
+
+            async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+                # Telethon的所有请求（包括下载文件的分块请求）都经过_call，FloodWait由限速器等待和学习
+                # 不用super()：takeout代理对象也会以自己为self调用这个方法
+                if flood_sleep_threshold is None:
+                    flood_sleep_threshold = self.pacing_max_sleep
+                return await rate_controller.call(
+                    self, request, lambda: base._call(self, sender, request, ordered, 0), flood_sleep_threshold
+                )
+
+            def disconnect(self):
+                rate_controller.save(session_path_of(self))
+                return base.disconnect(self)
+
+        _client_classes[base] = PacedTelegramClient
+    return _client_classes[base]
+
+
+def __getattr__(name):
+    """The paced TelegramClient, built on first use so importing this module does not import Telethon"""
+    if name == 'TelegramClient':
+        return paced_client_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,23 +1,32 @@
 import sys
-sys.stdout.reconfigure(encoding='utf-8')
-sys.stderr.reconfigure(encoding='utf-8')
+import startup_profile
+startup_profile.enable_if_requested()
 
-from telethon import TelegramClient, events, functions, types
+from telethon import events, functions, types
+from rate_control import TelegramClient, rate_controller
+from telethon.errors import FloodWaitError, FileReferenceExpiredError
 import csv
 from datetime import datetime
 import asyncio
+import contextlib
+import contextvars
 import os
 import json
+import time
 import logging
 from pathlib import Path
 import argparse
 import random
+import signal
+import heapq
 from config import (
     API_ID,
     API_HASH,
     MEDIA_DIR,
     PROXY_CONFIGS
 )
+from message_source import CSV_FIELDS, parquet_available, write_parquet, document_reference, update_sticker_index
+from media_store import get_media_store
 
 # Configure logging
 logging.basicConfig(
@@ -25,7 +34,8 @@ logging.basicConfig(
     format='%(message)s',
     handlers=[
         logging.StreamHandler(),
-        logging.FileHandler('telegram_scraper.log', encoding='utf-8')
+        # 日志固定写在脚本目录，不随启动时的工作目录散落
+        logging.FileHandler(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_scraper.log'), encoding='utf-8')
     ]
 )
 
@@ -43,88 +53,134 @@ def get_user_sessions_dir(user_email):
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(SESSIONS_DIR, exist_ok=True)
 
+# Message types that carry media
+MEDIA_TYPES = ['photo', 'video', 'sticker', 'file']
+
+# 每处理多少条消息保存一次检查点
+CHECKPOINT_INTERVAL = 100
+# 消息行每攒够多少条写入一次磁盘
+WRITE_BATCH_SIZE = 100
+
+# 同时下载的媒体文件数量
+DEFAULT_MEDIA_CONCURRENCY = 4
+# 单个媒体文件遇到FloodWait时的最大重试次数
+MEDIA_MAX_RETRIES = 3
+# 按ID批量重新获取消息时每批的数量（Telegram单次请求上限）
+REFETCH_BATCH_SIZE = 100
+
+# 批量模式下同时抓取的群组数量
+DEFAULT_GROUP_CONCURRENCY = 3
+# 导出模式下takeout会话允许下载的最大文件大小（字节）
+TAKEOUT_MAX_FILE_SIZE = 2000 * 1024 * 1024
+# 实时跟踪模式下新消息和媒体落盘的间隔（秒）
+FOLLOW_FLUSH_INTERVAL = 5
+# 实时跟踪模式下新消息合并进最终CSV的间隔（秒），合并要重写整个文件，所以间隔更长
+FOLLOW_MERGE_INTERVAL = 60
+
+# --types可选的消息类型，与CSV的type列一致；video是type为file的视频消息
+FILTER_TYPES = ['text', 'photo', 'video', 'sticker', 'file']
+# 可以交给服务端过滤的类型组合（Telegram没有贴纸、文本的过滤器，文件过滤器不包含视频和语音）
+SERVER_FILTERS = {
+    frozenset(['photo']): 'InputMessagesFilterPhotos',
+    frozenset(['video']): 'InputMessagesFilterVideo',
+    frozenset(['photo', 'video']): 'InputMessagesFilterPhotoVideo'
+}
+
+# 批量模式下当前任务正在抓取的群组，事件里带上它以区分各群组的进度
+current_group = contextvars.ContextVar('current_group', default=None)
+
+def emit(event):
+    """Print one JSON progress event, tagged with its group in batch mode"""
+    group = current_group.get()
+    if group is not None:
+        event = dict(event, group=group)
+    print(json.dumps(event))
+
 def sanitize_filename(filename):
     """Clean filename, remove illegal characters"""
     return "".join(c for c in filename if c.isalnum() or c in (' ', '-', '_', '.'))
 
-async def download_media(message, group_folder):
-    """Download media files"""
-    try:
-        if message.media:
-            media_folder = os.path.join(group_folder, 'media')
-            os.makedirs(media_folder, exist_ok=True)
-            
-            # Get media type and filename
-            if hasattr(message.media, 'photo'):
-                # Handle photos
-                file_name = f"photo_{message.id}.jpg"
-                media_type = "photo"
-            elif hasattr(message.media, 'document'):
-                # Handle documents
-                if message.sticker:
-                    file_name = f"sticker_{message.id}.webp"
-                    media_type = "sticker"
-                    # 只为贴纸保存额外信息
-                    document = message.media.document
-                    sticker_info = {
-                        'id': document.id,
-                        'access_hash': document.access_hash,
-                        'file_reference': document.file_reference.hex()
-                    }
-                    # 保存sticker信息到json文件
-                    json_file_name = f"sticker_{message.id}.json"
-                    json_file_path = os.path.join(media_folder, json_file_name)
-                    with open(json_file_path, 'w', encoding='utf-8') as f:
-                        json.dump(sticker_info, f, indent=2)
-                elif message.video:
-                    file_name = f"video_{message.id}.mp4"
-                    media_type = "video"
-                elif message.voice:
-                    file_name = f"voice_{message.id}.ogg"
-                    media_type = "voice"
-                elif message.audio:
-                    extension = message.audio.mime_type.split('/')[-1]
-                    file_name = f"audio_{message.id}.{extension}"
-                    media_type = "audio"
-                else:
-                    # Generic document
-                    original_name = getattr(message.document, 'file_name', '')
-                    extension = original_name.split('.')[-1] if original_name and '.' in original_name else 'bin'
-                    file_name = f"doc_{message.id}.{extension}"
-                    media_type = "document"
-            else:
-                return None
-                
-            # Clean filename
-            file_name = sanitize_filename(file_name)
-            file_path = os.path.join(media_folder, file_name)
-            
-            try:
-                # Download using the message object directly
-                await message.download_media(file_path)
-                # 返回相对于group_folder的路径，使用media/作为前缀
-                return f"media/{file_name}"
-            except Exception as e:
-                # If direct download fails, try alternative method
-                try:
-                    if hasattr(message.media, 'photo'):
-                        # For photos, get the largest size
-                        photo = message.photo
-                        if photo:
-                            await message.client.download_media(photo, file_path)
-                            return f"media/{file_name}"
-                    elif hasattr(message.media, 'document'):
-                        # For documents, use document attribute
-                        document = message.media.document
-                        if document:
-                            await message.client.download_media(document, file_path)
-                            return f"media/{file_name}"
-                except Exception as inner_e:
-                    logging.error(f"Alternative download method failed: {str(inner_e)}")
-                    
-    except Exception as e:
-        logging.error(f"Failed to download media: {str(e)}")
-    return None
+def get_media_ref(message):
+    """Build a compact media reference from a message, so it can be downloaded without refetching"""
+    if not message.media:
+        return None
+    
+    # Get media type and filename
+    if hasattr(message.media, 'photo'):
+        # Handle photos
+        file_name = f"photo_{message.id}.jpg"
+        media_type = "photo"
+        handle = message.photo
+    elif hasattr(message.media, 'document'):
+        # Handle documents
+        handle = message.media.document
+        if message.sticker:
+            file_name = f"sticker_{message.id}.webp"
+            media_type = "sticker"
+        elif message.video:
+            file_name = f"video_{message.id}.mp4"
+            media_type = "video"
+        elif message.voice:
+            file_name = f"voice_{message.id}.ogg"
+            media_type = "voice"
+        elif message.audio:
+            extension = message.audio.mime_type.split('/')[-1]
+            file_name = f"audio_{message.id}.{extension}"
+            media_type = "audio"
+        else:
+            # Generic document
+            original_name = getattr(message.document, 'file_name', '')
+            extension = original_name.split('.')[-1] if original_name and '.' in original_name else 'bin'
+            file_name = f"doc_{message.id}.{extension}"
+            media_type = "document"
+    else:
+        return None
+    
+    if not handle:
+        return None
+    
+    # 只保留下载需要的Photo/Document句柄，不保留整个Message对象
+    return {
+        'id': message.id,
+        'type': media_type,
+        'file_name': sanitize_filename(file_name),
+        'handle': handle
+    }
+
+async def download_media_ref(client, media_ref, group_folder, sticker_index=None, media_store=None):
+    """Download a media file from a compact media reference; returns (path, downloaded)"""
+    media_folder = os.path.join(group_folder, 'media')
+    os.makedirs(media_folder, exist_ok=True)
+    
+    file_path = os.path.join(media_folder, media_ref['file_name'])
+    if media_store is not None:
+        # 已经在媒体仓库里的文件只建立链接，不再下载
+        kind = 'photo' if media_ref['type'] == 'photo' else 'document'
+        downloaded = await media_store.fetch(client, kind, media_ref['handle'], file_path)
+    else:
+        await client.download_media(media_ref['handle'], file_path)
+        downloaded = True
+    
+    if sticker_index is not None and media_ref['type'] == 'sticker':
+        # 贴纸的引用记录到统一的索引里，发送时可以直接按ID发送
+        sticker_index[media_ref['id']] = document_reference(media_ref['handle'], 'sticker')
+    
+    # 返回相对于group_folder的路径，使用media/作为前缀
+    return f"media/{media_ref['file_name']}", downloaded
+
+async def fetch_media_refs(client, entity, message_ids):
+    """Refetch messages in batches and build media references for them"""
+    media_refs = {}
+    message_ids = [int(message_id) for message_id in message_ids]
+    for i in range(0, len(message_ids), REFETCH_BATCH_SIZE):
+        batch = message_ids[i:i + REFETCH_BATCH_SIZE]
+        for message in await client.get_messages(entity, ids=batch):
+            # 已删除的消息返回None
+            if message:
+                media_ref = get_media_ref(message)
+                if media_ref:
+                    media_refs[message.id] = media_ref
+    return media_refs
 
 async def get_message_content(message):
     """Get message content and type"""
@@ -167,25 +223,25 @@ async def connect_with_session(session_file, user_email):
             await client.connect()
             
             if not await client.is_user_authorized():
-                print(json.dumps({
+                emit({
                     "type": "error",
                     "message": "Session is not authorized"
-                }))
+                })
                 return None
                 
-            print(json.dumps({
+            emit({
                 "type": "info",
                 "message": "Successfully connected"
-            }))
+            })
             return client
             
         except Exception as e:
             error_msg = str(e)
             if attempt < MAX_RETRIES - 1:
-                print(json.dumps({
+                emit({
                     "type": "info",
                     "message": f"Connection attempt {attempt + 1} failed, retrying in {RETRY_DELAY} seconds... Error: {error_msg}"
-                }))
+                })
                 await asyncio.sleep(RETRY_DELAY)
                 continue
             
@@ -201,9 +257,354 @@ async def connect_with_session(session_file, user_email):
     }), file=sys.stderr)
     return None
 
-async def scrape_group(client, group_username, message_limit=1000, user_email=None):
-    """Scrape messages from a group with progress updates"""
+@contextlib.asynccontextmanager
+async def open_export_session(client, enabled=True):
+    """Scrape inside a Telegram takeout session, meant for bulk export
+
+    Yields (client, takeout): the takeout client and True, or the plain client
+    and False when export mode is off or Telegram refuses the takeout.
+    """
+    if not enabled:
+        yield client, False
+        return
+    
+    from telethon.errors import TakeoutInitDelayError
+    async with contextlib.AsyncExitStack() as stack:
+        takeout = None
+        try:
+            if client.session.takeout_id is not None:
+                # 上次导出没有正常结束（例如进程被杀），先结束旧的takeout会话
+                await client.end_takeout(success=False)
+            takeout = await stack.enter_async_context(client.takeout(
+                finalize=True,
+                chats=True,
+                megagroups=True,
+                channels=True,
+                files=True,
+                max_file_size=TAKEOUT_MAX_FILE_SIZE
+            ))
+            emit({
+                'type': 'info',
+                'message': 'Export mode: scraping inside a takeout session'
+            })
+        except TakeoutInitDelayError as e:
+            # 新账号或刚导出过的账号需要在Telegram应用里确认导出请求，或者等待一段时间
+            emit({
+                'type': 'warning',
+                'message': f'Takeout session delayed by Telegram for {e.seconds} seconds (confirm the data export request in the Telegram app), using normal scraping'
+            })
+        except Exception as e:
+            emit({
+                'type': 'warning',
+                'message': f'Takeout session refused ({str(e)}), using normal scraping'
+            })
+        yield takeout or client, takeout is not None
+
+def parse_filter_date(value):
+    """Parse a --since/--until value (ISO date or datetime, local time unless it has an offset)"""
+    if value is None or isinstance(value, datetime):
+        return value
+    # 不带时区的时间按本机时区理解，转成带时区的时间与消息日期比较
+    return datetime.fromisoformat(value).astimezone()
+
+def build_history_filter(message_types=None, since=None, until=None, topic_id=None):
+    """Translate the type, date range and topic options into iter_messages arguments
+
+    Returns (kwargs, filters): filters is the JSON-serialisable description saved
+    in the scrape state, None when nothing is filtered.
+    """
+    since, until = parse_filter_date(since), parse_filter_date(until)
+    kwargs = {}
+    if until:
+        # offset_date：从这个时间之前的消息开始向旧的方向拉取
+        kwargs['offset_date'] = until
+    if topic_id:
+        kwargs['reply_to'] = topic_id
+    server_filter = SERVER_FILTERS.get(frozenset(message_types or []))
+    if server_filter and not topic_id:
+        # Telegram在话题（reply_to）里不支持过滤器，话题内的类型只在客户端过滤
+        kwargs['filter'] = getattr(types, server_filter)
+    
+    filters = {
+        'types': sorted(message_types) if message_types else None,
+        'since': since.isoformat() if since else None,
+        'until': until.isoformat() if until else None,
+        'topic_id': topic_id,
+        'server_filter': server_filter if 'filter' in kwargs else None
+    }
+    if not any(filters.values()):
+        return kwargs, None
+    return kwargs, filters
+
+def message_matches(message, msg_type, message_types):
+    """Check a message against the --types filter on the client side"""
+    if not message_types:
+        return True
+    return msg_type in message_types or ('video' in message_types and bool(message.video))
+
+async def get_target_count(client, entity, message_limit, min_id=0, offset_id=0, history_filter=None):
+    """Get the number of messages a scrape will walk, without iterating the history"""
+    try:
+        if offset_id:
+            # 恢复运行：剩余的消息都在检查点和高水位之间
+            return max(min(offset_id - 1 - min_id, message_limit), 0)
+        if min_id:
+            # 增量模式：用最新消息ID估算新消息数量
+            latest = await client.get_messages(entity, limit=1)
+            if latest:
+                return max(min(latest[0].id - min_id, message_limit), 0)
+            return 0
+        # limit=0 只返回群组报告的总数，不拉取消息本身（有服务端过滤器时是过滤后的总数）
+        history = await client.get_messages(entity, limit=0, **(history_filter or {}))
+        total = getattr(history, 'total', None)
+        if total is not None:
+            return min(total, message_limit)
+    except Exception as e:
+        emit({
+            'type': 'info',
+            'message': f'Failed to get reported message count, using limit as total: {str(e)}'
+        })
+    return message_limit
+
+def load_scrape_state(state_file):
+    """Load the per-group scrape state (high-water mark and interrupted run)"""
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logging.error(f"Failed to load scrape state {state_file}: {str(e)}")
+        return {}
+
+def save_scrape_state(state_file, state):
+    """Save the per-group scrape state atomically"""
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, state_file)
+
+def iter_csv_rows(csv_file):
+    """Iterate over the rows of a scraped messages CSV without loading it all"""
+    if not os.path.exists(csv_file):
+        return
+    with open(csv_file, 'r', newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+def read_csv_ids(csv_file):
+    """Read the message ids already present in a scraped messages CSV"""
+    return {int(row['id']) for row in iter_csv_rows(csv_file) if row.get('id')}
+
+class StreamingCSVWriter:
+    """Stream message rows to a partial CSV, record media paths in a sidecar, and finalize atomically"""
+
+    def __init__(self, csv_file, keep_existing=False):
+        self.csv_file = csv_file
+        # 抓取中的消息写入.part文件，下载好的媒体路径写入.media旁路文件
+        self.part_file = csv_file + '.part'
+        self.media_file = csv_file + '.media'
+        # 增量模式下最终文件保留已有的消息
+        self.keep_existing = keep_existing
+        self.pending = []
+        self.rows_written = 0
+        self._part = None
+        self._writer = None
+        self._media = None
+        self._media_writer = None
+
+    def open(self, resume=False):
+        """Open the partial CSV, continuing it when resuming an interrupted run"""
+        resume = resume and os.path.exists(self.part_file)
+        self._part = open(self.part_file, 'a' if resume else 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._part, fieldnames=CSV_FIELDS)
+        self._media = open(self.media_file, 'a' if resume else 'w', newline='', encoding='utf-8')
+        self._media_writer = csv.writer(self._media)
+        if not resume:
+            self._writer.writeheader()
+        return resume
+
+    def write(self, row):
+        """Queue a row and flush it with the next batch"""
+        self.pending.append(row)
+        self.rows_written += 1
+        if len(self.pending) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write queued rows to disk"""
+        if self.pending:
+            self._writer.writerows(self.pending)
+            self.pending = []
+        self._part.flush()
+
+    def add_media(self, message_id, media_path):
+        """Record a downloaded media path without rewriting the CSV"""
+        self._media_writer.writerow([message_id, media_path])
+        self._media.flush()
+
+    def read_media(self):
+        """Read the media paths recorded so far"""
+        if not os.path.exists(self.media_file):
+            return {}
+        with open(self.media_file, 'r', newline='', encoding='utf-8') as f:
+            return {row[0]: row[1] for row in csv.reader(f) if len(row) == 2}
+
+    def iter_part_rows(self):
+        """Iterate over the rows written to the partial CSV"""
+        self.flush()
+        return iter_csv_rows(self.part_file)
+
+    def close(self):
+        """Flush queued rows and close the partial files"""
+        if self._part and not self._part.closed:
+            self.flush()
+        for f in (self._part, self._media):
+            if f and not f.closed:
+                f.close()
+
+    def finalize(self, oldest_first=False):
+        """Merge existing rows, new rows and media paths into the final CSV with one atomic rename
+
+        oldest_first: the partial CSV was written oldest to newest (live tail)
+        and is reversed on merge.
+        """
+        self.close()
+        media_paths = self.read_media()
+        tmp_file = self.csv_file + '.tmp'
+        new_rows = iter_csv_rows(self.part_file)
+        if oldest_first:
+            new_rows = reversed(list(new_rows))
+        new_rows = (dict(row, media_file=media_paths.get(row['id'], row['media_file'])) for row in new_rows)
+        if self.keep_existing:
+            # 两边都是从新到旧，按ID归并：新消息在前，补缺口的旧消息插回它们的位置
+            new_rows = heapq.merge(new_rows, iter_csv_rows(self.csv_file), key=lambda row: -int(row['id']))
+        with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(new_rows)
+        os.replace(tmp_file, self.csv_file)
+        os.remove(self.part_file)
+        os.remove(self.media_file)
+
+async def download_media_files(client, entity, media_refs, group_folder, concurrency=DEFAULT_MEDIA_CONCURRENCY,
+                               on_downloaded=None, sticker_index=None, media_store=None):
+    """Download media for the given media references with a bounded pool of workers"""
+    media_paths = {}
+    total = len(media_refs)
+    if not total:
+        return media_paths
+    
+    queue = asyncio.Queue()
+    for media_ref in media_refs:
+        queue.put_nowait(media_ref)
+    
+    stats = {'done': 0, 'files': 0, 'bytes': 0, 'reused': 0}
+    start_time = time.time()
+    # FloodWait是按账号计算的，一个worker碰到后所有worker都暂停到同一时间
+    flood = {'until': 0.0}
+    
+    async def wait_for_flood():
+        delay = flood['until'] - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    async def fetch_one(media_ref):
+        for attempt in range(MEDIA_MAX_RETRIES):
+            await wait_for_flood()
+            try:
+                return await download_media_ref(client, media_ref, group_folder, sticker_index, media_store)
+            except FileReferenceExpiredError:
+                # 文件引用过期，只重新获取这一条消息
+                refreshed = await fetch_media_refs(client, entity, [media_ref['id']])
+                if media_ref['id'] not in refreshed:
+                    return None, False
+                media_ref = refreshed[media_ref['id']]
+            except FloodWaitError as e:
+                flood['until'] = max(flood['until'], time.time() + e.seconds)
+                emit({
+                    'type': 'info',
+                    'message': f'FloodWait for {e.seconds} seconds while downloading media for message {media_ref["id"]}, attempt {attempt + 1}/{MEDIA_MAX_RETRIES}'
+                })
+        raise Exception(f'Still failing after {MEDIA_MAX_RETRIES} attempts')
+    
+    async def worker():
+        while True:
+            try:
+                media_ref = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                media_path, downloaded = await fetch_one(media_ref)
+                if media_path:
+                    media_paths[str(media_ref['id'])] = media_path
+                    if on_downloaded:
+                        on_downloaded(media_ref['id'], media_path)
+                    if downloaded:
+                        stats['files'] += 1
+                        stats['bytes'] += os.path.getsize(os.path.join(group_folder, media_path))
+                    else:
+                        stats['reused'] += 1
+            except Exception as e:
+                emit({
+                    'type': 'warning',
+                    'message': f'Failed to process media for message {media_ref["id"]}: {str(e)}'
+                })
+            finally:
+                stats['done'] += 1
+                elapsed = max(time.time() - start_time, 0.001)
+                emit({
+                    'type': 'progress',
+                    'current': stats['done'],
+                    'total': total,
+                    'percentage': int((stats['done'] / total) * 100),
+                    'message': f'Processing media file {stats["done"]}/{total}',
+                    'reused': stats['reused'],
+                    'filesPerSecond': round(stats['files'] / elapsed, 2),
+                    'mbPerSecond': round(stats['bytes'] / elapsed / (1024 * 1024), 2)
+                })
+    
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, total)))))
+    
+    elapsed = max(time.time() - start_time, 0.001)
+    emit({
+        'type': 'info',
+        'message': f'Downloaded {stats["files"]}/{total} media files in {elapsed:.1f}s, '
+                   f'{stats["reused"]} reused from the media store '
+                   f'({stats["files"] / elapsed:.2f} files/s, {stats["bytes"] / elapsed / (1024 * 1024):.2f} MB/s)'
+    })
+    return media_paths
+
+async def save_group_media(client, entity, group_username, group_folder, writer, media_refs,
+                           concurrency=DEFAULT_MEDIA_CONCURRENCY, use_media_store=True):
+    """Download media into a group folder, record the paths in writer and index the stickers"""
+    sticker_index = {}
+    try:
+        await download_media_files(
+            client, entity, media_refs, group_folder, concurrency,
+            on_downloaded=writer.add_media,
+            sticker_index=sticker_index,
+            media_store=get_media_store(DATA_DIR) if use_media_store else None
+        )
+    finally:
+        # 中途失败也保存已下载贴纸的引用
+        if sticker_index:
+            # 记录来源群组，发送时可以重新获取原消息刷新过期的引用
+            for entry in sticker_index.values():
+                entry['chat'] = group_username
+            update_sticker_index(os.path.join(group_folder, 'media'), sticker_index)
+
+async def scrape_group(client, group_username, message_limit=1000, user_email=None, incremental=False,
+                       media_concurrency=DEFAULT_MEDIA_CONCURRENCY, output_format='csv', use_media_store=True,
+                       takeout=False, message_types=None, since=None, until=None, topic_id=None):
+    """Scrape messages from a group with progress updates (takeout: client is a takeout session)
+
+    message_types, since/until and topic_id select a slice of the history; as
+    much of it as possible is filtered by Telegram.
+    """
     try:
+        history_filter, filters = build_history_filter(message_types, since, until, topic_id)
+        since = parse_filter_date(since)
+
         # Get the input entity with retry
         MAX_RETRIES = 3
         RETRY_DELAY = 5
@@ -215,10 +616,10 @@ async def scrape_group(client, group_username, message_limit=1000, user_email=No
                 break
             except Exception as e:
                 if attempt < MAX_RETRIES - 1:
-                    print(json.dumps({
+                    emit({
                         "type": "info",
                         "message": f"Failed to get entity, attempt {attempt + 1}/{MAX_RETRIES}. Retrying in {RETRY_DELAY} seconds..."
-                    }))
+                    })
                     await asyncio.sleep(RETRY_DELAY)
                 else:
                     raise e
@@ -234,172 +635,540 @@ async def scrape_group(client, group_username, message_limit=1000, user_email=No
         
         # CSV file path
         csv_file = os.path.join(group_folder, f'{sanitize_filename(group_username)}_messages.csv')
+        # 每个群组的抓取进度（高水位消息ID和未完成的运行）保存在CSV旁边
+        state_file = os.path.join(group_folder, f'{sanitize_filename(group_username)}_state.json')
+        state = load_scrape_state(state_file) if incremental else {}
+        if state and state.get('filters') != filters:
+            # 高水位和检查点只对同样的过滤条件有效
+            emit({
+                'type': 'warning',
+                'message': 'Filters differ from the previous scrape of this group, running a full scrape'
+            })
+            state = {}
         
-        # Get total message count with retry
-        total_messages = 0
-        for attempt in range(MAX_RETRIES):
-            try:
-                # 计算实际的总消息数
-                async for _ in client.iter_messages(entity):
-                    total_messages += 1
-                    if total_messages >= message_limit:  # 如果达到限制就停止计数
-                        break
-                break
-            except Exception as e:
-                if attempt < MAX_RETRIES - 1:
-                    print(json.dumps({
-                        "type": "info",
-                        "message": f"Failed to get message count, attempt {attempt + 1}/{MAX_RETRIES}. Retrying..."
-                    }))
-                    await asyncio.sleep(RETRY_DELAY)
-                else:
-                    raise e
+        run = state.get('run')
+        writer = StreamingCSVWriter(csv_file)
+        if run and not os.path.exists(writer.part_file):
+            run = None  # 检查点对应的部分文件已不存在，重新开始
+        existing_ids = set()
+        if run:
+            # 上一次运行被中断，从检查点继续
+            existing_ids = read_csv_ids(writer.part_file)
+            emit({
+                'type': 'info',
+                'message': f"Resuming interrupted run from message {run['offset_id']} ({run['fetched']}/{run['limit']} fetched)"
+            })
+        else:
+            run = {
+                'min_id': state.get('last_id', 0),
+                'max_id': 0,
+                'offset_id': 0,
+                'limit': message_limit,
+                'fetched': 0,
+                'gap': state.get('gap')
+            }
+            if run['min_id']:
+                emit({
+                    'type': 'info',
+                    'message': f"Incremental mode: fetching messages newer than {run['min_id']}"
+                })
+        if filters:
+            emit({
+                'type': 'info',
+                'message': f"Filters: {json.dumps(filters)}"
+            })
+        remaining = max(run['limit'] - run['fetched'], 0)
+        # 增量模式下新消息追加在已有消息之后
+        writer.keep_existing = bool(incremental and run['min_id'] and os.path.exists(csv_file))
         
-        # 使用目标消息数量作为total
-        target_messages = min(total_messages, message_limit)
+        # 单次遍历：不再先完整遍历一遍计数，只向服务器要一次群组报告的总数
+        target_messages = await get_target_count(client, entity, remaining, min_id=run['min_id'], offset_id=run['offset_id'],
+                                                 history_filter=history_filter)
         
-        print(json.dumps({
+        emit({
             'type': 'start',
             'total': target_messages
-        }))
+        })
         
-        # 第一步：先抓取所有消息内容
-        messages = []
+        # 第一步：一边遍历一边流式写入消息，媒体消息只保留紧凑的媒体引用
+        media_refs = {}
+        media_count = 0
         processed = 0
         last_progress = -1
         last_update_time = time.time()
         UPDATE_INTERVAL = 2  # 每2秒至少发送一次进度更新
         
-        print(json.dumps({
+        emit({
             'type': 'info',
             'message': 'Step 1: Fetching messages...'
-        }))
+        })
         
-        async for message in client.iter_messages(entity, limit=message_limit):
-            processed += 1
-            progress = int((processed / target_messages) * 100)
-            current_time = time.time()
+        writer.open(resume=bool(existing_ids))
+        try:
+            if run.get('filling_gap'):
+                existing_ids |= read_csv_ids(csv_file)
+            while True:
+                iter_kwargs = dict(history_filter)
+                if run['offset_id']:
+                    # 恢复运行或补缺口时从检查点继续，不再用日期定位
+                    iter_kwargs.pop('offset_date', None)
+                walk_limit = max(run['limit'] - run['fetched'], 0)
+                walked = 0
+                reached = False
+                # Telethon在超过3000条时每页之间默认等待1秒；takeout会话的限制宽松得多，不需要等待
+                history = client.iter_messages(entity, limit=walk_limit, min_id=run['min_id'], offset_id=run['offset_id'],
+                                               wait_time=0 if takeout else None, **iter_kwargs)
+                async for message in history:
+                    if since and message.date < since:
+                        reached = True
+                        break  # 消息从新到旧返回，之后的都早于--since
+                    processed += 1
+                    progress = min(int((processed / target_messages) * 100), 100) if target_messages else 100
+                    current_time = time.time()
             
-            if progress != last_progress or (current_time - last_update_time) >= UPDATE_INTERVAL:
-                print(json.dumps({
-                    'type': 'progress',
-                    'current': processed,
-                    'total': target_messages,
-                    'percentage': progress
-                }))
-                last_progress = progress
-                last_update_time = current_time
+                    if progress != last_progress or (current_time - last_update_time) >= UPDATE_INTERVAL:
+                        emit({
+                            'type': 'progress',
+                            'current': processed,
+                            'total': target_messages,
+                            'percentage': progress
+                        })
+                        last_progress = progress
+                        last_update_time = current_time
+                
+                    # 消息按从新到旧返回，第一条就是本次运行的最大ID
+                    run['max_id'] = max(run['max_id'], message.id)
+                    run['offset_id'] = message.id
+                    run['fetched'] += 1
+                    walked += 1
             
-            try:
-                # 检查消息发送者是否是机器人
-                if message.sender and hasattr(message.sender, 'bot') and message.sender.bot:
-                    continue  # 跳过机器人的消息
+                    try:
+                        if message.id in existing_ids:
+                            continue  # 中断前已写入的消息，或补缺口时已在CSV里的消息
+                    
+                        # 检查消息发送者是否是机器人
+                        if message.sender and hasattr(message.sender, 'bot') and message.sender.bot:
+                            continue  # 跳过机器人的消息
                     
-                content, msg_type = await get_message_content(message)
-                messages.append({
-                    'id': message.id,
-                    'date': message.date.isoformat(),
-                    'type': msg_type,
-                    'content': content,
-                    'media_file': ''  # 先留空，后面再处理媒体文件
+                        content, msg_type = await get_message_content(message)
+                        if not message_matches(message, msg_type, message_types):
+                            continue  # 服务端无法过滤的类型
+                        writer.write({
+                            'id': message.id,
+                            'date': message.date.isoformat(),
+                            'type': msg_type,
+                            'content': content,
+                            'media_file': ''  # 先留空，媒体路径下载后记录在旁路文件
+                        })
+                        if msg_type in MEDIA_TYPES:
+                            media_count += 1
+                            media_ref = get_media_ref(message)
+                            if media_ref:
+                                media_refs[message.id] = media_ref
+                    except Exception as e:
+                        emit({
+                            'type': 'warning',
+                            'message': f'Error processing message {message.id}: {str(e)}'
+                        })
+                        continue
+                    finally:
+                        if run['fetched'] % CHECKPOINT_INTERVAL == 0:
+                            # 先落盘消息再记录检查点，保证检查点之前的消息都已写入
+                            writer.flush()
+                            save_scrape_state(state_file, dict(state, run=run))
+
+                # 没用完数量就结束说明已经走到了min_id（或--since）
+                reached = reached or walked < walk_limit
+                if run.get('filling_gap'):
+                    run['gap'] = None if reached else [run['min_id'], run['offset_id']]
+                    break
+                if not reached:
+                    if run['min_id'] and walk_limit:
+                        # 数量用完时还没走到上次的高水位，中间没抓到的区间留给下次运行
+                        gap = [run['min_id'], run['offset_id']]
+                        if run.get('gap'):
+                            # 只记一个缺口：合并成覆盖两者的区间，已在CSV里的消息补的时候跳过
+                            gap = [min(gap[0], run['gap'][0]), max(gap[1], run['gap'][1])]
+                        run['gap'] = gap
+                    break
+                if not run.get('gap') or run['fetched'] >= run['limit']:
+                    break
+                # 新消息已经抓完，用剩下的数量补上次没抓完的区间
+                emit({
+                    'type': 'info',
+                    'message': f"Filling the gap left by an earlier run: messages {run['gap'][0] + 1}-{run['gap'][1] - 1}"
                 })
-            except Exception as e:
-                print(json.dumps({
-                    'type': 'warning',
-                    'message': f'Error processing message {message.id}: {str(e)}'
-                }))
-                continue
+                run['min_id'], run['offset_id'] = run['gap']
+                run['filling_gap'] = True
+                existing_ids |= read_csv_ids(csv_file)
+            
+            writer.flush()
+            save_scrape_state(state_file, dict(state, run=run))
+            
+            # 在开始处理媒体文件之前，先发送结果信息
+            emit({
+                'type': 'result',
+                'data': {
+                    'group': group_username,
+                    'totalMessages': writer.rows_written,
+                    'mediaFiles': media_count,
+                    'csvFile': csv_file,
+                    'folderPath': group_folder
+                }
+            })
+
+            emit({
+                'type': 'info',
+                'message': 'Step 2: Processing media files...'
+            })
+            
+            # 处理本次运行中还没有媒体路径的消息，包括中断前写入的消息
+            downloaded = writer.read_media()
+            media_ids = [int(row['id']) for row in writer.iter_part_rows()
+                         if row['type'] in MEDIA_TYPES and row['id'] not in downloaded]
+            # 第一遍没有拿到引用的消息按100条一批重新获取
+            missing_ids = [message_id for message_id in media_ids if message_id not in media_refs]
+            if missing_ids:
+                media_refs.update(await fetch_media_refs(client, entity, missing_ids))
+            await save_group_media(client, entity, group_username, group_folder, writer,
+                                   [media_refs[message_id] for message_id in media_ids if message_id in media_refs],
+                                   media_concurrency, use_media_store)
+        finally:
+            writer.close()
         
-        # 写入消息到CSV
-        print(json.dumps({
+        # 合并消息和媒体路径，原子替换最终CSV
+        emit({
             'type': 'info',
-            'message': 'Writing messages to CSV file...'
-        }))
+            'message': 'Finalizing CSV with media file paths...'
+        })
+        writer.finalize()
         
-        with open(csv_file, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['id', 'date', 'type', 'content', 'media_file'])
-            writer.writeheader()
-            writer.writerows(messages)
+        if output_format == 'parquet':
+            if parquet_available():
+                try:
+                    parquet_file = write_parquet(csv_file)
+                    emit({
+                        'type': 'info',
+                        'message': f'Wrote Parquet message source: {parquet_file}'
+                    })
+                except Exception as e:
+                    emit({
+                        'type': 'warning',
+                        'message': f'Failed to write Parquet message source, CSV only: {str(e)}'
+                    })
+            else:
+                emit({
+                    'type': 'warning',
+                    'message': 'pyarrow is not installed, writing CSV only'
+                })
         
-        # 在开始处理媒体文件之前，先发送结果信息
-        print(json.dumps({
-            'type': 'result',
-            'data': {
-                'group': group_username,
-                'totalMessages': len(messages),
-                'mediaFiles': len([msg for msg in messages if msg['type'] in ['photo', 'video', 'sticker', 'file']]),
-                'csvFile': csv_file,
-                'folderPath': group_folder
-            }
-        }))
-
-        print(json.dumps({
-            'type': 'info',
-            'message': 'Step 2: Processing media files...'
-        }))
+        # 本次运行完成，推进高水位并清除检查点
+        state.pop('run', None)
+        state['last_id'] = max(state.get('last_id', 0), run['max_id'])
+        if run.get('gap'):
+            state['gap'] = run['gap']
+            emit({
+                'type': 'warning',
+                'message': f"Limit reached before the previous scrape, messages {run['gap'][0] + 1}-{run['gap'][1] - 1} are fetched next run"
+            })
+        else:
+            state.pop('gap', None)
+        state['filters'] = filters
+        state['updated_at'] = datetime.now().isoformat()
+        save_scrape_state(state_file, state)
+        
+        # 发送完成消息，包含更多信息
+        emit({
+            'type': 'complete',
+            'message': 'Successfully scraped messages',
+            'csv_file': csv_file,
+            'pacing': rate_controller.snapshot(client)
+        })
+        return csv_file
         
-        # 处理媒体文件
-        media_messages = [msg for msg in messages if msg['type'] in ['photo', 'video', 'sticker', 'file']]
-        for i, msg in enumerate(media_messages, 1):
+    except Exception as e:
+        emit({
+            'type': 'error',
+            'message': str(e)
+        })
+        raise e
+
+async def scrape_groups(client, groups, message_limit=1000, user_email=None,
+                        group_concurrency=DEFAULT_GROUP_CONCURRENCY, **options):
+    """Scrape several groups concurrently over one connected client"""
+    semaphore = asyncio.Semaphore(max(1, group_concurrency))
+    
+    async def scrape_one(group):
+        async with semaphore:
+            # 每个群组在自己的任务里运行，设置的群组只对这个任务生效
+            current_group.set(group)
+            start_time = time.time()
             try:
-                print(json.dumps({
-                    'type': 'progress',
-                    'current': i,
-                    'total': len(media_messages),
-                    'percentage': int((i / len(media_messages)) * 100),
-                    'message': f'Processing media file {i}/{len(media_messages)}'
-                }))
-                
-                # 获取原始消息对象
-                msg_obj = await client.get_messages(entity, ids=msg['id'])
-                if msg_obj and msg_obj.media:
-                    media_path = await download_media(msg_obj, group_folder)
-                    if media_path:
-                        msg['media_file'] = media_path
+                csv_file = await scrape_group(client, group, message_limit, user_email, **options)
+                return {'group': group, 'status': 'success', 'csvFile': csv_file,
+                        'seconds': round(time.time() - start_time, 1)}
             except Exception as e:
-                print(json.dumps({
-                    'type': 'warning',
-                    'message': f'Failed to process media for message {msg["id"]}: {str(e)}'
-                }))
+                return {'group': group, 'status': 'error', 'error': str(e),
+                        'seconds': round(time.time() - start_time, 1)}
+    
+    emit({
+        'type': 'batch_start',
+        'groups': groups,
+        'concurrency': group_concurrency
+    })
+    results = await asyncio.gather(*(scrape_one(group) for group in groups))
+    emit({
+        'type': 'batch_complete',
+        'succeeded': sum(1 for result in results if result['status'] == 'success'),
+        'failed': sum(1 for result in results if result['status'] != 'success'),
+        'results': results
+    })
+    return results
+
+def get_message_topic_id(message):
+    """Get the forum topic a message belongs to, or None outside topics"""
+    reply_to = getattr(message, 'reply_to', None)
+    if reply_to and getattr(reply_to, 'forum_topic', False):
+        return reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+    return None
+
+def install_stop_handler(stop_event):
+    """Set stop_event on SIGINT/SIGTERM (and Ctrl+Break on Windows) instead of killing the loop"""
+    loop = asyncio.get_running_loop()
+    for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+        sig = getattr(signal, name, None)
+        if sig is None:
+            continue
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows的事件循环不支持add_signal_handler，信号处理函数在主线程里运行
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
+
+async def follow_group(client, group_username, message_limit=1000, user_email=None, stop_event=None,
+                       flush_interval=FOLLOW_FLUSH_INTERVAL, merge_interval=FOLLOW_MERGE_INTERVAL,
+                       media_concurrency=DEFAULT_MEDIA_CONCURRENCY, use_media_store=True,
+                       message_types=None, topic_id=None, **options):
+    """Catch up on a group from the last stored message, then append new messages as they arrive
+
+    Runs until stop_event is set. New rows go to the partial CSV and are
+    flushed every flush_interval seconds together with their media; every
+    merge_interval seconds (and on stop) they are merged into the final CSV.
+    """
+    stop_event = stop_event or asyncio.Event()
+    entity = await client.get_input_entity(group_username)
+    
+    # 先订阅再追赶，追赶期间到达的消息在队列里等着，不会漏掉
+    queue = asyncio.Queue()
+    
+    async def on_new_message(event):
+        queue.put_nowait(event.message)
+    
+    client.add_event_handler(on_new_message, events.NewMessage(chats=entity))
+    try:
+        csv_file = await scrape_group(client, group_username, message_limit, user_email, incremental=True,
+                                      media_concurrency=media_concurrency, use_media_store=use_media_store,
+                                      message_types=message_types, topic_id=topic_id, **options)
+        group_folder = os.path.dirname(csv_file)
+        state_file = os.path.join(group_folder, f'{sanitize_filename(group_username)}_state.json')
+        state = load_scrape_state(state_file)
+        emit({
+            'type': 'follow_start',
+            'group': group_username,
+            'lastId': state.get('last_id', 0)
+        })
         
-        # 更新CSV中的媒体文件路径
-        print(json.dumps({
-            'type': 'info',
-            'message': 'Updating CSV with media file paths...'
-        }))
+        writer = None
+        batch_ids = set()
+        media_refs = {}
+        total_rows = 0
+        last_flush = last_merge = time.monotonic()
         
-        with open(csv_file, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['id', 'date', 'type', 'content', 'media_file'])
-            writer.writeheader()
-            writer.writerows(messages)
+        async def flush():
+            # 消息落盘后再下载媒体，路径记录在旁路文件里
+            writer.flush()
+            if media_refs:
+                refs = list(media_refs.values())
+                media_refs.clear()
+                await save_group_media(client, entity, group_username, group_folder, writer, refs,
+                                       media_concurrency, use_media_store)
         
-        # 发送完成消息，包含更多信息
-        print(json.dumps({
-            'type': 'complete',
-            'message': 'Successfully scraped messages',
-            'csv_file': csv_file
-        }))
+        async def merge():
+            nonlocal writer
+            await flush()
+            writer.finalize(oldest_first=True)
+            state['last_id'] = max(state.get('last_id', 0), max(batch_ids))
+            state['updated_at'] = datetime.now().isoformat()
+            save_scrape_state(state_file, state)
+            emit({
+                'type': 'follow_flush',
+                'rows': writer.rows_written,
+                'totalRows': total_rows,
+                'lastId': state['last_id']
+            })
+            writer = None
+            batch_ids.clear()
+        
+        async def append(message):
+            nonlocal writer, total_rows
+            if message.id <= state.get('last_id', 0) or message.id in batch_ids:
+                return  # 追赶时已经抓到的消息
+            # 检查消息发送者是否是机器人
+            if message.sender and hasattr(message.sender, 'bot') and message.sender.bot:
+                return
+            if topic_id and get_message_topic_id(message) != topic_id:
+                return
+            content, msg_type = await get_message_content(message)
+            if not message_matches(message, msg_type, message_types):
+                return
+            if writer is None:
+                writer = StreamingCSVWriter(csv_file, keep_existing=True)
+                writer.open()
+            writer.write({
+                'id': message.id,
+                'date': message.date.isoformat(),
+                'type': msg_type,
+                'content': content,
+                'media_file': ''
+            })
+            batch_ids.add(message.id)
+            total_rows += 1
+            if msg_type in MEDIA_TYPES:
+                media_ref = get_media_ref(message)
+                if media_ref:
+                    media_refs[message.id] = media_ref
+            emit({
+                'type': 'new_message',
+                'id': message.id,
+                'messageType': msg_type
+            })
+        
+        try:
+            while True:
+                stopping = stop_event.is_set()
+                try:
+                    # 停止时只取完队列里剩下的消息
+                    message = queue.get_nowait() if stopping else await asyncio.wait_for(queue.get(), timeout=1)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    message = None
+                
+                if message is not None:
+                    try:
+                        await append(message)
+                    except Exception as e:
+                        emit({
+                            'type': 'warning',
+                            'message': f'Error processing message {message.id}: {str(e)}'
+                        })
+                elif stopping:
+                    break
+                
+                now = time.monotonic()
+                if writer is not None and now - last_flush >= flush_interval:
+                    await flush()
+                    last_flush = now
+                if writer is not None and now - last_merge >= merge_interval:
+                    await merge()
+                    last_merge = now
+        finally:
+            # 停止或出错时把已收到的消息合并进最终CSV
+            if writer is not None:
+                await merge()
         
+        emit({
+            'type': 'complete',
+            'message': f'Stopped following, {total_rows} new messages saved',
+            'csv_file': csv_file,
+            'pacing': rate_controller.snapshot(client)
+        })
+        return csv_file
+    
     except Exception as e:
-        print(json.dumps({
+        emit({
             'type': 'error',
             'message': str(e)
-        }))
+        })
         raise e
+    finally:
+        client.remove_event_handler(on_new_message)
+
+def read_groups_file(groups_file):
+    """Read group names from a job file, one per line ('#' starts a comment)"""
+    groups = []
+    with open(groups_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            group = line.split('#', 1)[0].strip()
+            if group:
+                groups.append(group)
+    return groups
 
 async def main():
-    parser = argparse.ArgumentParser(description='Scrape messages from Telegram group')
+    parser = argparse.ArgumentParser(description='Scrape messages from Telegram group', allow_abbrev=False)
     parser.add_argument('--session', required=True, help='Path to session file')
-    parser.add_argument('--group', required=True, help='Group username or ID')
+    parser.add_argument('--group', nargs='+', default=[], help='Group username or ID (several groups are scraped concurrently)')
+    parser.add_argument('--groups-file', help='Job file with one group per line, scraped in addition to --group')
+    parser.add_argument('--group-concurrency', type=int, default=DEFAULT_GROUP_CONCURRENCY, help='Number of groups to scrape at once')
     parser.add_argument('--limit', type=int, default=1000, help='Maximum number of messages to scrape')
     parser.add_argument('--user-email', required=True, help='User email for organizing data')
     parser.add_argument('--timeout', type=int, default=90, help='Timeout in seconds')
+    parser.add_argument('--incremental', action='store_true', help='Only fetch messages newer than the last scrape and append them')
+    parser.add_argument('--media-concurrency', type=int, default=DEFAULT_MEDIA_CONCURRENCY, help='Number of media files to download at once')
+    parser.add_argument('--output-format', choices=['csv', 'parquet'], default='csv', help='Also write a typed Parquet copy of the messages (requires pyarrow)')
+    parser.add_argument('--no-media-store', action='store_true', help='Download media straight into the group folder instead of the shared media store')
+    parser.add_argument('--export', action='store_true', help='Scrape inside a Telegram takeout session for bulk export (falls back to normal scraping if refused)')
+    parser.add_argument('--types', nargs='+', choices=FILTER_TYPES, help='Only keep these message types (photo/video are filtered by Telegram)')
+    parser.add_argument('--since', help='Only messages from this date/time on (ISO format, local time)')
+    parser.add_argument('--until', help='Only messages before this date/time (ISO format, local time)')
+    parser.add_argument('--topic-id', type=int, help='Only messages of this forum topic')
+    parser.add_argument('--follow', action='store_true', help='After catching up, keep appending new messages as they arrive until stopped (SIGINT/SIGTERM)')
+    parser.add_argument('--flush-interval', type=float, default=FOLLOW_FLUSH_INTERVAL, help='Seconds between writes of new messages and media in --follow mode')
+    parser.add_argument('--startup-profile', action='store_true', help='Print import time per module to stderr at exit')
     
     args = parser.parse_args()
     
+    groups = list(args.group)
+    if args.groups_file:
+        groups += read_groups_file(args.groups_file)
+    # 去重但保持顺序
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        parser.error('at least one --group or a --groups-file is required')
+    try:
+        parse_filter_date(args.since)
+        parse_filter_date(args.until)
+    except ValueError as e:
+        parser.error(f'invalid --since/--until date: {str(e)}')
+    if args.follow and len(groups) > 1:
+        parser.error('--follow takes a single group')
+    if args.follow and (args.until or args.export):
+        parser.error('--follow cannot be combined with --until or --export')
+    
+    client = None
     try:
         client = await connect_with_session(args.session, args.user_email)
-        await scrape_group(client, args.group, args.limit, args.user_email)
+        if args.follow:
+            # pm2停止进程时发送SIGTERM（Windows上是SIGINT），收到后合并已收到的消息再退出
+            stop_event = asyncio.Event()
+            install_stop_handler(stop_event)
+            await follow_group(client, groups[0], args.limit, args.user_email, stop_event,
+                               flush_interval=args.flush_interval, media_concurrency=args.media_concurrency,
+                               use_media_store=not args.no_media_store, message_types=args.types,
+                               since=args.since, topic_id=args.topic_id)
+            return
+        # 一个session同时只能有一个takeout会话，所以批量抓取时所有群组共用一个
+        async with open_export_session(client, args.export) as (scrape_client, takeout):
+            options = dict(incremental=args.incremental, media_concurrency=args.media_concurrency,
+                           output_format=args.output_format, use_media_store=not args.no_media_store,
+                           takeout=takeout, message_types=args.types, since=args.since, until=args.until,
+                           topic_id=args.topic_id)
+            if len(groups) == 1:
+                await scrape_group(scrape_client, groups[0], args.limit, args.user_email, **options)
+            else:
+                # 一个连接、一个进程抓取所有群组
+                results = await scrape_groups(scrape_client, groups, args.limit, args.user_email,
+                                              group_concurrency=args.group_concurrency, **options)
+                if any(result['status'] != 'success' for result in results):
+                    sys.exit(1)
     except Exception as e:
         logging.error(f"Error: {str(e)}")
         sys.exit(1)
@@ -410,9 +1179,8 @@ async def main():
             pass
 
 if __name__ == "__main__":
-    import sys
-    import os
-    import time
+    sys.stdout.reconfigure(encoding='utf-8')
+    sys.stderr.reconfigure(encoding='utf-8')
     
     if os.name == 'nt':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -0,0 +1,68 @@
+"""
+On-disk cache of session check results, shared by test_sessions.py and get_session_info.py
+"""
+import os
+import json
+import time
+
+# 缓存文件保存在用户的sessions目录下
+CACHE_FILE_NAME = '.session_cache.json'
+# 缓存有效期（秒），0 表示不使用缓存
+DEFAULT_CACHE_TTL = 300
+
+
+class SessionCache:
+    """Last known status of each session, keyed by session file name and mtime"""
+
+    def __init__(self, sessions_dir, ttl=DEFAULT_CACHE_TTL):
+        self.cache_file = os.path.join(sessions_dir, CACHE_FILE_NAME)
+        self.ttl = ttl
+        self.entries = {}
+        self.dirty = False
+        if ttl > 0 and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception:
+                # 缓存损坏时直接重新检测
+                self.entries = {}
+
+    def get(self, session_path):
+        """Get the cached record of a session if it is fresh and the file has not changed"""
+        if self.ttl <= 0:
+            return None
+        entry = self.entries.get(os.path.basename(session_path))
+        if not entry or not os.path.exists(session_path):
+            return None
+        if entry.get('mtime') != os.path.getmtime(session_path):
+            return None
+        if time.time() - entry.get('checked_at', 0) > self.ttl:
+            return None
+        return entry
+
+    def put(self, session_path, record):
+        """Store a session record; call after the client has disconnected so the mtime is final"""
+        if not os.path.exists(session_path):
+            return
+        # Telethon连接时会写session文件，所以mtime要在断开后读取
+        self.entries[os.path.basename(session_path)] = dict(
+            record,
+            mtime=os.path.getmtime(session_path),
+            checked_at=time.time()
+        )
+        self.dirty = True
+
+    def invalidate(self, session_path):
+        """Drop the cached record of a session, e.g. after its profile was changed"""
+        if self.entries.pop(os.path.basename(session_path), None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the cache back to disk atomically"""
+        if not self.dirty:
+            return
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
@@ -0,0 +1,64 @@
+"""
+Claims on a user's sessions directory held by a running auto_chat.py, so the worker does not open the same session files
+"""
+import os
+import json
+import time
+import asyncio
+
+# 声明文件保存在用户的sessions目录下，每个进程一个
+CLAIM_PREFIX = '.auto_chat_'
+CLAIM_SUFFIX = '.claim'
+# 持有进程刷新声明文件的间隔（秒）
+CLAIM_REFRESH_INTERVAL = 30
+# 超过这个时间没有刷新就认为持有进程已经退出（Windows上不能用信号检查进程是否存在）
+CLAIM_STALE = 120
+
+
+class SessionClaim:
+    """Claim on every session of a directory, refreshed while the process is running"""
+
+    def __init__(self, sessions_dir):
+        self.claim_file = os.path.join(sessions_dir, f'{CLAIM_PREFIX}{os.getpid()}{CLAIM_SUFFIX}')
+
+    def write(self):
+        """Create or refresh the claim file"""
+        os.makedirs(os.path.dirname(self.claim_file), exist_ok=True)
+        tmp_file = self.claim_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'pid': os.getpid(), 'updatedAt': time.time()}, f)
+        os.replace(tmp_file, self.claim_file)
+
+    async def keep_alive(self):
+        """Refresh the claim file every CLAIM_REFRESH_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(CLAIM_REFRESH_INTERVAL)
+            try:
+                self.write()
+            except Exception as e:
+                print(f"Failed to refresh session claim: {str(e)}")
+
+    def remove(self):
+        """Give the sessions back"""
+        try:
+            os.remove(self.claim_file)
+        except FileNotFoundError:
+            pass
+
+
+def active_claims(sessions_dir):
+    """Claim files of a directory that their process is still refreshing"""
+    if not os.path.isdir(sessions_dir):
+        return []
+    now = time.time()
+    claims = []
+    for name in os.listdir(sessions_dir):
+        if not (name.startswith(CLAIM_PREFIX) and name.endswith(CLAIM_SUFFIX)):
+            continue
+        try:
+            if now - os.path.getmtime(os.path.join(sessions_dir, name)) <= CLAIM_STALE:
+                claims.append(name)
+        except FileNotFoundError:
+            # 持有进程刚好退出
+            continue
+    return claims
@@ -1,5 +1,8 @@
 import sys
-from telethon import TelegramClient
+import startup_profile
+startup_profile.enable_if_requested()
+
+from rate_control import TelegramClient, rate_controller
 from telethon.sessions import StringSession
 import os
 import asyncio
@@ -55,7 +58,8 @@ async def try_connect(phone, user_email, max_attempts=3):
             print(f"\n[ERROR] Hit flood wait error. Need to wait {e.seconds} seconds")
             if attempt < max_attempts - 1:
                 print(f"Waiting {e.seconds} seconds before next attempt...")
-                await asyncio.sleep(e.seconds)
+                # 等待经过限速器，记录下来并与使用同一session的其他脚本共享
+                await rate_controller.wait_out(client, e)
             else:
                 raise e
                 
@@ -84,10 +88,11 @@ async def try_connect(phone, user_email, max_attempts=3):
     return False
 
 async def main():
-    parser = argparse.ArgumentParser(description='Generate Telegram session file')
+    parser = argparse.ArgumentParser(description='Generate Telegram session file', allow_abbrev=False)
     parser.add_argument('phone', help='Phone number with country code')
     parser.add_argument('--output-dir', help='Output directory for session file')
     parser.add_argument('--user-email', help='User email for session directory', required=True)
+    parser.add_argument('--startup-profile', action='store_true', help='Print import time per module to stderr at exit')
     args = parser.parse_args()
     
     try:
@@ -0,0 +1,61 @@
+"""
+Import timing for --startup-profile, printed in the same layout as python -X importtime
+
+Scripts call enable_if_requested() before their own imports, which enables it
+when --startup-profile is on the command line. The report goes to stderr so JSON printed on stdout is unaffected.
+"""
+import sys
+import time
+import atexit
+import builtins
+
+_started = time.perf_counter()
+_records = []
+_stack = []
+_reported = False
+
+
+def _timed_import(original_import):
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        # 已经加载过的模块只是查表，不计时
+        if not name or (level == 0 and name in sys.modules):
+            return original_import(name, globals, locals, fromlist, level)
+        _stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = _stack.pop()
+            if _stack:
+                _stack[-1] += elapsed
+            _records.append((name, elapsed - children, elapsed, len(_stack)))
+    return timed_import
+
+
+def enable():
+    """Time every module imported from now on and report at exit"""
+    builtins.__import__ = _timed_import(builtins.__import__)
+    atexit.register(report)
+
+
+def enable_if_requested():
+    """Call enable() when --startup-profile is on the command line"""
+    # 在脚本导入其他模块之前调用，argparse还没运行，只认完整的--startup-profile，所以各脚本的解析器都设置了allow_abbrev=False
+    if '--startup-profile' in sys.argv:
+        enable()
+
+
+def report():
+    """Print the import times collected so far (only once)"""
+    global _reported
+    if _reported:
+        return
+    _reported = True
+    lines = ["import time: self [us] | cumulative | imported package"]
+    for name, self_time, cumulative, depth in _records:
+        lines.append(f"import time: {self_time * 1e6:9.0f} | {cumulative * 1e6:10.0f} | {'  ' * depth}{name}")
+    total_imports = sum(cumulative for _, _, cumulative, depth in _records if depth == 0)
+    lines.append(f"startup: {total_imports:.3f}s in imports, {time.perf_counter() - _started:.3f}s since start")
+    sys.stderr.write('\n'.join(lines) + '\n')
+    sys.stderr.flush()
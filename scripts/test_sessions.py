@@ -1,14 +1,23 @@
-import os
 import sys
+import startup_profile
+startup_profile.enable_if_requested()
+
+import os
 import json
 import asyncio
-from telethon import TelegramClient
+from rate_control import TelegramClient
 from datetime import datetime
 import argparse
 from config import API_ID, API_HASH, PROXY_CONFIGS
+from session_cache import SessionCache, DEFAULT_CACHE_TTL
 
-async def test_session(session_path):
-    """Test a single session file"""
+# 同时测试的session数量和单个session的超时时间（秒）
+DEFAULT_CONCURRENCY = 10
+DEFAULT_TIMEOUT = 30
+
+async def test_session(session_path, cache=None, client=None):
+    """Test a single session file, optionally with an already connected client from the worker pool"""
+    record = None
     try:
         # 从session文件名中提取电话号码
         session_name = os.path.basename(session_path)
@@ -18,25 +27,30 @@ async def test_session(session_path):
         sys.stderr.write(f"Testing session {session_name} with proxy {proxy_config['addr']}:{proxy_config['port']}\n")
         sys.stderr.flush()
         
-        client = TelegramClient(
-            session_path.replace('.session', ''),
-            API_ID,
-            API_HASH,
-            proxy={
-                'proxy_type': proxy_config['proxy_type'],
-                'addr': proxy_config['addr'],
-                'port': proxy_config['port'],
-                'username': proxy_config['username'],
-                'password': proxy_config['password'],
-                'rdns': True
-            }
-        )
+        # 常驻worker传入的客户端已经连接，由连接池负责断开
+        owns_client = client is None
+        if owns_client:
+            client = TelegramClient(
+                session_path.replace('.session', ''),
+                API_ID,
+                API_HASH,
+                proxy={
+                    'proxy_type': proxy_config['proxy_type'],
+                    'addr': proxy_config['addr'],
+                    'port': proxy_config['port'],
+                    'username': proxy_config['username'],
+                    'password': proxy_config['password'],
+                    'rdns': True
+                }
+            )
         
         try:
-            await client.connect()
+            if owns_client:
+                await client.connect()
             if not await client.is_user_authorized():
                 sys.stderr.write(f"Session {session_name} is not authorized\n")
                 sys.stderr.flush()
+                record = {'status': 'invalid', 'error': 'Not authorized'}
                 return {
                     'id': phone,
                     'session': session_name,
@@ -48,6 +62,13 @@ async def test_session(session_path):
             me = await client.get_me()
             sys.stderr.write(f"Session {session_name} is valid (username: @{me.username})\n")
             sys.stderr.flush()
+            record = {
+                'status': 'valid',
+                'username': me.username,
+                'first_name': me.first_name,
+                'last_name': me.last_name,
+                'user_id': me.id
+            }
             return {
                 'id': phone,
                 'session': session_name,
@@ -68,10 +89,14 @@ async def test_session(session_path):
                 'timestamp': datetime.now().isoformat()
             }
         finally:
-            try:
-                await client.disconnect()
-            except:
-                pass
+            if owns_client:
+                try:
+                    await client.disconnect()
+                except:
+                    pass
+            # 只缓存确定的结果，连接错误下次重新检测
+            if cache and record:
+                cache.put(session_path, record)
                 
     except Exception as e:
         sys.stderr.write(f"Fatal error testing session {session_path}: {str(e)}\n")
@@ -84,9 +109,53 @@ async def test_session(session_path):
             'timestamp': datetime.now().isoformat()
         }
 
+def result_from_cache(session_path, entry):
+    """Build a test result from a cached session record"""
+    session_name = os.path.basename(session_path)
+    phone = session_name.replace('.session', '')
+    result = {
+        'id': phone,
+        'session': session_name,
+        'status': entry['status'],
+    }
+    if entry['status'] == 'valid':
+        result['username'] = entry.get('username')
+        result['phone'] = phone
+    else:
+        result['error'] = entry.get('error')
+    result['timestamp'] = datetime.fromtimestamp(entry['checked_at']).isoformat()
+    return result
+
+async def test_session_with_timeout(session_path, semaphore, timeout, cache=None):
+    """Test a session inside the concurrency limit, giving up after timeout seconds"""
+    entry = cache.get(session_path) if cache else None
+    if entry:
+        sys.stderr.write(f"Using cached result for session {os.path.basename(session_path)}\n")
+        sys.stderr.flush()
+        return result_from_cache(session_path, entry)
+    
+    async with semaphore:
+        try:
+            return await asyncio.wait_for(test_session(session_path, cache), timeout=timeout)
+        except asyncio.TimeoutError:
+            session_name = os.path.basename(session_path)
+            sys.stderr.write(f"Testing session {session_name} timed out after {timeout} seconds\n")
+            sys.stderr.flush()
+            return {
+                'id': session_name.replace('.session', ''),
+                'session': session_name,
+                'status': 'error',
+                'error': f'Timed out after {timeout} seconds',
+                'timestamp': datetime.now().isoformat()
+            }
+
 async def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(allow_abbrev=False)
     parser.add_argument('--sessions-dir', required=True, help='Sessions directory path')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of sessions to test at once')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Timeout in seconds for each session')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, help='Reuse results younger than this many seconds (0 disables the cache)')
+    parser.add_argument('--startup-profile', action='store_true', help='Print import time per module to stderr at exit')
     args = parser.parse_args()
     
     sys.stderr.write(f"Checking sessions in directory: {args.sessions_dir}\n")
@@ -109,12 +178,14 @@ async def main():
         sys.stdout.flush()
         return
         
-    # 测试每个session文件
-    results = []
-    for session_file in session_files:
-        session_path = os.path.join(args.sessions_dir, session_file)
-        result = await test_session(session_path)
-        results.append(result)
+    # 并发测试session文件，结果顺序与文件顺序一致
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+    cache = SessionCache(args.sessions_dir, args.cache_ttl)
+    results = await asyncio.gather(*(
+        test_session_with_timeout(os.path.join(args.sessions_dir, session_file), semaphore, args.timeout, cache)
+        for session_file in session_files
+    ))
+    cache.save()
     
     # 确保只输出 JSON 到标准输出
     sys.stdout.write(json.dumps(results))
@@ -1,9 +1,12 @@
-import os
 import sys
+import startup_profile
+startup_profile.enable_if_requested()
+
+import os
 import json
 import logging
 import re
-from telethon import TelegramClient
+from rate_control import TelegramClient
 from telethon.errors import (
     FloodWaitError,
     UsernameOccupiedError,
@@ -14,6 +17,7 @@ from telethon.tl.functions.account import UpdateProfileRequest, UpdateUsernameRe
 from telethon.tl.functions.photos import UploadProfilePhotoRequest
 from telethon.tl.types import InputFile
 from config import API_ID, API_HASH, DEFAULT_PROXY, get_user_sessions_dir
+from session_cache import SessionCache
 
 # 配置日志，使用utf-8编码
 logging.basicConfig(
@@ -23,11 +27,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 设置stdout为utf-8编码
-import codecs
-sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
-sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
-
 def validate_username(username: str) -> bool:
     """验证用户名是否符合Telegram的要求"""
     if not username:
@@ -42,7 +41,7 @@ def validate_username(username: str) -> bool:
     username_regex = re.compile(r'^[a-zA-Z][\w\d]{3,30}[a-zA-Z\d]$')
     return bool(username_regex.match(username))
 
-async def update_profile(user_email: str, session_name: str, first_name: str = None, last_name: str = None, username: str = None, photo_path: str = None):
+async def update_profile(user_email: str, session_name: str, first_name: str = None, last_name: str = None, username: str = None, photo_path: str = None, client: TelegramClient = None):
     try:
         # 获取用户的sessions目录
         sessions_dir = get_user_sessions_dir(user_email)
@@ -59,16 +58,19 @@ async def update_profile(user_email: str, session_name: str, first_name: str = N
 
         logger.info(f"正在处理session: {session_name}")
 
-        # 创建客户端实例，使用代理
-        client = TelegramClient(
-            session_file,
-            API_ID,
-            API_HASH,
-            proxy=DEFAULT_PROXY
-        )
+        # 创建客户端实例，使用代理；常驻worker传入的客户端已经连接，由连接池负责断开
+        owns_client = client is None
+        if owns_client:
+            client = TelegramClient(
+                session_file,
+                API_ID,
+                API_HASH,
+                proxy=DEFAULT_PROXY
+            )
         
         try:
-            await client.connect()
+            if owns_client:
+                await client.connect()
             
             if not await client.is_user_authorized():
                 logger.warning(f"Session未授权: {session_name}")
@@ -174,6 +176,11 @@ async def update_profile(user_email: str, session_name: str, first_name: str = N
                     }
                 }
                 logger.info(f"账号信息更新成功: {session_name}")
+
+                # 资料已变化，清除该session的检测缓存
+                cache = SessionCache(sessions_dir)
+                cache.invalidate(session_file)
+                cache.save()
                 return result
 
             except FloodWaitError as e:
@@ -196,8 +203,9 @@ async def update_profile(user_email: str, session_name: str, first_name: str = N
                 'error': str(e)
             }
         finally:
-            await client.disconnect()
-            logger.info(f"已断开与Telegram的连接: {session_name}")
+            if owns_client:
+                await client.disconnect()
+                logger.info(f"已断开与Telegram的连接: {session_name}")
 
     except Exception as e:
         logger.error(f"发生未预期的错误: {str(e)}")
@@ -209,14 +217,19 @@ async def update_profile(user_email: str, session_name: str, first_name: str = N
 if __name__ == '__main__':
     import asyncio
     
-    # 从命令行参数获取信息
-    if len(sys.argv) != 3:
-        logger.error('Usage: python update_profile.py <user_email> <json_config>')
+    # 设置stdout为utf-8编码（只在作为脚本运行时，导入时不改动调用方的输出）
+    sys.stdout.reconfigure(encoding='utf-8')
+    sys.stderr.reconfigure(encoding='utf-8')
+    
+    # 从命令行参数获取信息（--startup-profile已在导入前处理，报告在退出时打印）
+    argv = [arg for arg in sys.argv[1:] if arg != '--startup-profile']
+    if len(argv) != 2:
+        logger.error('Usage: python update_profile.py <user_email> <json_config> [--startup-profile]')
         sys.exit(1)
 
-    user_email = sys.argv[1]
+    user_email = argv[0]
     try:
-        config = json.loads(sys.argv[2])
+        config = json.loads(argv[1])
         logger.info(f"收到更新请求: {json.dumps(config, ensure_ascii=False)}")
         
         if 'session_name' not in config:
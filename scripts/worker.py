@@ -0,0 +1,411 @@
+"""
+Long-lived worker that keeps connected Telegram clients and runs jobs for the Next.js routes
+
+Routes POST a JSON body to http://127.0.0.1:8765/jobs/<name> instead of spawning a
+new python process per request. Clients are kept connected per session file and
+disconnected after they have been idle for a while.
+"""
+import sys
+import startup_profile
+startup_profile.enable_if_requested()
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from datetime import datetime
+from rate_control import TelegramClient, rate_controller
+from config import API_ID, API_HASH, PROXY_CONFIGS, BASE_SESSIONS_DIR, WORKER_HOST, WORKER_PORT, get_user_sessions_dir
+from test_sessions import test_session, result_from_cache, DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT
+from session_cache import SessionCache, DEFAULT_CACHE_TTL
+from get_session_info import get_session_info
+from session_claims import active_claims
+from update_profile import update_profile
+from scrape_messages import (
+    scrape_group, scrape_groups, open_export_session, parse_filter_date,
+    DEFAULT_MEDIA_CONCURRENCY, DEFAULT_GROUP_CONCURRENCY, FILTER_TYPES
+)
+
+# 客户端空闲多久（秒）后断开
+DEFAULT_IDLE_TIMEOUT = 600
+# 单次连接的超时时间（秒）
+DEFAULT_CONNECT_TIMEOUT = 30
+# 请求体大小上限
+MAX_BODY_SIZE = 1024 * 1024
+# 释放连接时等待正在运行的任务的检查间隔（秒）
+RELEASE_POLL_INTERVAL = 0.5
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict', 500: 'Internal Server Error'}
+
+
+def log(message):
+    """Write a worker log line to stderr"""
+    sys.stderr.write(f"[{datetime.now().isoformat(timespec='seconds')}] {message}\n")
+    sys.stderr.flush()
+
+
+class BadRequest(Exception):
+    """Invalid job parameters, answered with 400 instead of 500"""
+
+
+class SessionClaimed(Exception):
+    """Session files held open by a running auto chat, answered with 409"""
+
+
+class ClientPool:
+    """Connected TelegramClients kept per session file"""
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.clients = {}
+        self.locks = {}
+        self.export_locks = {}
+        self.users = {}
+        self.last_used = {}
+
+    @staticmethod
+    def key(session_path):
+        """Normalise a session path (with or without .session) to the name Telethon uses"""
+        if session_path.endswith('.session'):
+            session_path = session_path[:-len('.session')]
+        return os.path.normcase(os.path.abspath(session_path))
+
+    async def connect(self, key):
+        """Get the connected client of a session, connecting it if needed"""
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            # 自动聊天在单独的进程里打开了这个目录的session文件，同时连接会锁住数据库或导致AUTH_KEY_DUPLICATED
+            if active_claims(os.path.dirname(key)):
+                await self.release(key)
+                raise SessionClaimed(f"Session {os.path.basename(key)} is in use by a running auto chat")
+            client = self.clients.get(key)
+            if client and not client.is_connected():
+                log(f"Client for {os.path.basename(key)} was disconnected, reconnecting")
+                self.clients.pop(key, None)
+                client = None
+            if client is None:
+                # 不存在的session文件不要让Telethon新建一个空的
+                if not os.path.exists(key + '.session'):
+                    raise FileNotFoundError(f"Session file not found: {key}.session")
+                client = TelegramClient(key, API_ID, API_HASH, proxy=PROXY_CONFIGS[0])
+                try:
+                    await asyncio.wait_for(client.connect(), timeout=self.connect_timeout)
+                except Exception:
+                    await client.disconnect()
+                    raise
+                self.clients[key] = client
+                log(f"Connected {os.path.basename(key)} ({len(self.clients)} clients in pool)")
+            return client
+
+    @contextlib.asynccontextmanager
+    async def client(self, session_path):
+        """Borrow the connected client of a session for the duration of a job"""
+        key = self.key(session_path)
+        client = await self.connect(key)
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            yield client
+        finally:
+            self.users[key] -= 1
+            self.last_used[key] = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def export_lock(self, session_path, export=True):
+        """Run the export jobs of a session one at a time, an account can only hold one takeout session"""
+        if not export:
+            yield
+            return
+        async with self.export_locks.setdefault(self.key(session_path), asyncio.Lock()):
+            yield
+
+    async def release(self, key):
+        """Disconnect a pooled client unless a job is still using it"""
+        if self.users.get(key):
+            return False
+        client = self.clients.pop(key, None)
+        if client:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                log(f"Error disconnecting {os.path.basename(key)}: {str(e)}")
+            log(f"Disconnected {os.path.basename(key)} ({len(self.clients)} clients in pool)")
+        return True
+
+    async def release_dir(self, sessions_dir, wait=0):
+        """Disconnect the clients of one sessions directory, e.g. before auto chat opens them
+
+        Clients a job is still using are waited for up to wait seconds. Those
+        still in use after that stay connected and are returned as busy.
+        """
+        prefix = os.path.join(self.key(sessions_dir), '')
+        deadline = time.monotonic() + wait
+        released = []
+        while True:
+            busy = []
+            for key in [key for key in self.clients if key.startswith(prefix)]:
+                (released if await self.release(key) else busy).append(os.path.basename(key))
+            if not busy or time.monotonic() >= deadline:
+                return {'released': released, 'busy': busy}
+            await asyncio.sleep(RELEASE_POLL_INTERVAL)
+
+    async def evict_idle(self):
+        """Periodically disconnect clients that have been idle for idle_timeout seconds or whose sessions auto chat has claimed"""
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            now = time.monotonic()
+            for key in list(self.clients):
+                if now - self.last_used.get(key, now) > self.idle_timeout or active_claims(os.path.dirname(key)):
+                    await self.release(key)
+
+    async def close(self):
+        """Disconnect every pooled client"""
+        for key in list(self.clients):
+            self.users.pop(key, None)
+            await self.release(key)
+
+
+def session_error(session_path, error):
+    """Build a test result for a session that could not be tested"""
+    session_name = os.path.basename(session_path)
+    return {
+        'id': session_name.replace('.session', ''),
+        'session': session_name,
+        'status': 'error',
+        'error': error,
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+async def job_test_sessions(pool, params):
+    """Test every session in a directory, same output as test_sessions.py"""
+    sessions_dir = params['sessions_dir']
+    timeout = params.get('timeout', DEFAULT_TIMEOUT)
+    if not os.path.exists(sessions_dir):
+        return []
+    
+    semaphore = asyncio.Semaphore(max(1, params.get('concurrency', DEFAULT_CONCURRENCY)))
+    cache = SessionCache(sessions_dir, params.get('cache_ttl', DEFAULT_CACHE_TTL))
+    
+    async def test_one(session_path):
+        # 文件没有变化且结果还新鲜时不必连接
+        entry = cache.get(session_path)
+        if entry:
+            return result_from_cache(session_path, entry)
+        async with semaphore:
+            try:
+                async with pool.client(session_path) as client:
+                    result = await asyncio.wait_for(test_session(session_path, cache, client=client), timeout=timeout)
+            except asyncio.TimeoutError:
+                result = session_error(session_path, f'Timed out after {timeout} seconds')
+            except Exception as e:
+                result = session_error(session_path, str(e))
+            # 未授权的session不再占用连接
+            if result['status'] != 'valid':
+                await pool.release(pool.key(session_path))
+            return result
+    
+    session_files = [f for f in os.listdir(sessions_dir) if f.endswith('.session')]
+    try:
+        return await asyncio.gather(*(test_one(os.path.join(sessions_dir, f)) for f in session_files))
+    finally:
+        cache.save()
+
+
+async def job_session_info(pool, params):
+    """Get information for all sessions of a user, same records as get_session_info.py"""
+    sessions_dir = os.path.join(BASE_SESSIONS_DIR, params['user_email'])
+    if not os.path.exists(sessions_dir):
+        return []
+    
+    semaphore = asyncio.Semaphore(DEFAULT_CONCURRENCY)
+    
+    async def info_one(session_path):
+        async with semaphore:
+            try:
+                async with pool.client(session_path) as client:
+                    return await get_session_info(session_path, client=client)
+            except Exception as e:
+                log(f"Error getting info for {os.path.basename(session_path)}: {str(e)}")
+                return None
+    
+    session_files = [f for f in os.listdir(sessions_dir) if f.endswith('.session')]
+    results = await asyncio.gather(*(info_one(os.path.join(sessions_dir, f)) for f in session_files))
+    return [info for info in results if info]
+
+
+async def job_update_profile(pool, params):
+    """Update the profile of one session, same result as update_profile.py"""
+    if not params.get('session_name'):
+        return {'success': False, 'error': 'Session name is required'}
+    session_path = os.path.join(get_user_sessions_dir(params['user_email']), f"{params['session_name']}.session")
+    if not os.path.exists(session_path):
+        return {'success': False, 'error': 'Session file not found'}
+    
+    async with pool.client(session_path) as client:
+        return await update_profile(
+            user_email=params['user_email'],
+            session_name=params['session_name'],
+            first_name=params.get('first_name'),
+            last_name=params.get('last_name'),
+            username=params.get('username'),
+            photo_path=params.get('photo_path'),
+            client=client
+        )
+
+
+async def job_scrape(pool, params):
+    """Scrape a group (or a list of groups concurrently) with a pooled client, same files as scrape_messages.py"""
+    # 先检查参数，用户输入错误返回400而不是任务失败
+    try:
+        limit = int(params.get('limit', 1000))
+        parse_filter_date(params.get('since'))
+        parse_filter_date(params.get('until'))
+    except (TypeError, ValueError) as e:
+        raise BadRequest(f'Invalid limit or since/until date: {str(e)}')
+    unknown_types = set(params.get('types') or []) - set(FILTER_TYPES)
+    if unknown_types:
+        raise BadRequest(f"Unknown message types: {', '.join(sorted(unknown_types))}")
+    export = params.get('export', False)
+    options = dict(
+        incremental=params.get('incremental', False),
+        media_concurrency=params.get('media_concurrency', DEFAULT_MEDIA_CONCURRENCY),
+        output_format=params.get('output_format', 'csv'),
+        message_types=params.get('types'),
+        since=params.get('since'),
+        until=params.get('until'),
+        topic_id=params.get('topic_id')
+    )
+    async with pool.client(params['session']) as client:
+        if not await client.is_user_authorized():
+            raise Exception("Session is not authorized")
+        # 同一个session上并发的导出任务会互相结束对方的takeout，排队执行
+        async with pool.export_lock(params['session'], export):
+            async with open_export_session(client, export) as (scrape_client, takeout):
+                options['takeout'] = takeout
+                if 'groups' in params:
+                    results = await scrape_groups(
+                        scrape_client,
+                        params['groups'],
+                        limit,
+                        params['user_email'],
+                        group_concurrency=params.get('group_concurrency', DEFAULT_GROUP_CONCURRENCY),
+                        **options
+                    )
+                    return {'results': results}
+                csv_file = await scrape_group(scrape_client, params['group'], limit, params['user_email'], **options)
+    return {'csv_file': csv_file}
+
+
+async def job_release(pool, params):
+    """Disconnect the pooled clients of a user's sessions, waiting up to params['wait'] seconds for running jobs"""
+    return await pool.release_dir(get_user_sessions_dir(params['user_email']), float(params.get('wait', 0)))
+
+
+JOBS = {
+    'test_sessions': job_test_sessions,
+    'session_info': job_session_info,
+    'update_profile': job_update_profile,
+    'scrape': job_scrape,
+    'release': job_release
+}
+
+
+async def dispatch(pool, method, path, body):
+    """Route one request to a job and return (status, payload)"""
+    if method == 'GET' and path == '/health':
+        return 200, {'success': True, 'clients': len(pool.clients), 'pacing': rate_controller.snapshot()}
+    
+    name = path[len('/jobs/'):] if path.startswith('/jobs/') else None
+    if method != 'POST' or name not in JOBS:
+        return 404, {'success': False, 'error': f'Unknown job: {method} {path}'}
+    
+    try:
+        params = json.loads(body or b'{}')
+    except json.JSONDecodeError:
+        return 400, {'success': False, 'error': 'Invalid JSON body'}
+    
+    started = time.perf_counter()
+    try:
+        result = await JOBS[name](pool, params)
+        log(f"Job {name} finished in {time.perf_counter() - started:.2f}s")
+        return 200, {'success': True, 'result': result}
+    except KeyError as e:
+        return 400, {'success': False, 'error': f'Missing parameter: {e.args[0]}'}
+    except BadRequest as e:
+        return 400, {'success': False, 'error': str(e)}
+    except SessionClaimed as e:
+        return 409, {'success': False, 'error': str(e)}
+    except Exception as e:
+        log(f"Job {name} failed after {time.perf_counter() - started:.2f}s: {str(e)}")
+        return 500, {'success': False, 'error': str(e)}
+
+
+async def handle_connection(pool, reader, writer):
+    """Serve one HTTP/1.1 request and close the connection"""
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        
+        length = int(headers.get('content-length', 0))
+        if len(request_line) < 2 or length > MAX_BODY_SIZE:
+            status, payload = 400, {'success': False, 'error': 'Bad request'}
+        else:
+            body = await reader.readexactly(length) if length else b''
+            status, payload = await dispatch(pool, request_line[0], request_line[1], body)
+        
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+        writer.write((
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n"
+        ).encode('latin-1') + data)
+        await writer.drain()
+    except Exception as e:
+        log(f"Error handling request: {str(e)}")
+    finally:
+        writer.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Long-lived worker for Telegram jobs', allow_abbrev=False)
+    parser.add_argument('--host', default=WORKER_HOST, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=WORKER_PORT, help='Port to listen on')
+    parser.add_argument('--idle-timeout', type=int, default=DEFAULT_IDLE_TIMEOUT, help='Disconnect clients idle for this many seconds')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, help='Timeout in seconds for each connection attempt')
+    parser.add_argument('--startup-profile', action='store_true', help='Print import time per module to stderr at exit')
+    args = parser.parse_args()
+    
+    pool = ClientPool(args.idle_timeout, args.connect_timeout)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(pool, reader, writer),
+        args.host,
+        args.port
+    )
+    evictor = asyncio.create_task(pool.evict_idle())
+    log(f"Worker listening on http://{args.host}:{args.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        evictor.cancel()
+        await pool.close()
+
+
+if __name__ == '__main__':
+    sys.stdout.reconfigure(encoding='utf-8')
+    sys.stderr.reconfigure(encoding='utf-8')
+    if os.name == 'nt':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        log("Worker stopped")